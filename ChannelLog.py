@@ -0,0 +1,455 @@
+# Record PyroNode channels to disk, and read or replay the recordings
+#
+# A log is a directory of append-only segment files.  Each segment starts with a
+# 16 byte header and holds records of a 24 byte header (time, channel id, payload
+# length, payload kind) and a payload padded to 8 bytes.  Channel ids are defined by
+# a record of their own, repeated at the start of every segment so segments can be
+# read on their own.  Readers mmap the segments, and scalar and fixed shape array
+# channels load straight into numpy arrays, ie, for batch runs of the rule engine:
+#
+#   >>> log = LogReader('recordings/bed1')
+#   >>> times, frames = log.to_frames({'hr': ('bed1', 'hr'), 'spo2': ('bed1', 'spo2')})
+#   >>> rules.match_frames(frames)
+
+import os
+import json
+import mmap
+import struct
+import threading
+import logging
+import time
+from array import array
+from LazyModule import LazyModule
+from PyroNode import PyroNode, monotonic
+
+np = LazyModule('numpy')
+
+
+MAGIC = 'DUPPYLOG'
+VERSION = 1
+SEGMENT_HEADER = struct.Struct('<8sII')
+RECORD_HEADER = struct.Struct('<dIIB7x')
+
+# Payload kinds
+DEFINE, FLOAT, INT, ARRAY, JSON = range(5)
+
+
+def to_json(value):
+    # numpy values inside objects, ie, alert dicts
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('Can not record {0!r}'.format(value))
+
+
+def encode(value):
+    # (kind, payload bytes)
+    if isinstance(value, bool):
+        return JSON, json.dumps(value)
+    if isinstance(value, float) or isinstance(value, np.floating):
+        return FLOAT, struct.pack('<d', value)
+    if isinstance(value, (int, long)) or isinstance(value, np.integer):
+        if -2 ** 63 <= value < 2 ** 63:
+            return INT, struct.pack('<q', value)
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject and not value.dtype.names:
+        dtype = value.dtype.str
+        head = struct.pack('<B', len(dtype)) + dtype + struct.pack('<B', value.ndim)
+        head += struct.pack('<%dq' % value.ndim, *value.shape)
+        return ARRAY, head + np.ascontiguousarray(value).tobytes()
+    return JSON, json.dumps(value, default=to_json)
+
+
+def decode(kind, payload):
+    if kind == FLOAT:
+        return struct.unpack('<d', payload)[0]
+    if kind == INT:
+        return struct.unpack('<q', payload)[0]
+    if kind == ARRAY:
+        n = ord(payload[0])
+        dtype = payload[1:1 + n]
+        ndim = ord(payload[1 + n])
+        shape = struct.unpack_from('<%dq' % ndim, payload, 2 + n)
+        return np.frombuffer(payload, dtype=dtype, offset=2 + n + 8 * ndim).reshape(shape)
+    return json.loads(payload)
+
+
+def padded(length):
+    return (length + 7) & ~7
+
+
+class LogWriter(object):
+
+    # Appends records to the newest segment of a log directory, starting another
+    # once a segment reaches segment_size.  Existing segments are never rewritten.
+
+    def __init__(self, directory, segment_size=64 << 20):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.channel_ids = {}
+        self.lock = threading.Lock()
+        self.file = None
+        self.segment = max([segment_index(path) + 1 for path in segment_paths(directory)] or [0])
+        self.records = 0
+        self._open_segment()
+
+    def _write(self, timestamp, channel_id, kind, payload):
+        record = RECORD_HEADER.pack(timestamp, channel_id, len(payload), kind) + payload
+        self.file.write(record.ljust(padded(len(record)), '\0'))
+        self.size += padded(len(record))
+
+    def _open_segment(self):
+        if self.file:
+            self.file.close()
+        path = os.path.join(self.directory, 'segment-%06d.log' % self.segment)
+        self.segment += 1
+        self.file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL), 'wb')
+        self.file.write(SEGMENT_HEADER.pack(MAGIC, VERSION, 0))
+        self.size = SEGMENT_HEADER.size
+        for channel, channel_id in sorted(self.channel_ids.items(), key=lambda item: item[1]):
+            self._write(0., channel_id, DEFINE, json.dumps(list(channel)))
+        self.file.flush()
+
+    def write(self, timestamp, channel, value):
+        channel = tuple(channel)
+        kind, payload = encode(value)
+        with self.lock:
+            channel_id = self.channel_ids.get(channel)
+            if self.size + RECORD_HEADER.size + len(payload) > self.segment_size and self.records:
+                self._open_segment()
+            if channel_id is None:
+                channel_id = self.channel_ids[channel] = len(self.channel_ids)
+                self._write(0., channel_id, DEFINE, json.dumps(list(channel)))
+            self._write(timestamp, channel_id, kind, payload)
+            self.records += 1
+
+    def write_many(self, items):
+        # items of (channel, seq, time, value), as pushed to a subscriber
+        for channel, seq, timestamp, value in items:
+            self.write(timestamp, channel, value)
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def segment_paths(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.startswith('segment-') and name.endswith('.log'))
+
+
+def segment_index(path):
+    return int(os.path.basename(path)[len('segment-'):-len('.log')])
+
+
+class LogSegment(object):
+
+    # One mmap'd segment and an index of its records, built in one pass.  A record,
+    # or segment header, cut short by a writer that's still going is left out.
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.mmap = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else ''
+        if size >= SEGMENT_HEADER.size:
+            magic, version, reserved = SEGMENT_HEADER.unpack_from(self.mmap, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('Not a channel log segment: {0}'.format(path))
+
+        self.channels = {}
+        times, channel_ids, kinds, offsets, lengths = array('d'), array('l'), array('l'), array('l'), array('l')
+        offset = SEGMENT_HEADER.size
+        while offset + RECORD_HEADER.size <= size:
+            timestamp, channel_id, length, kind = RECORD_HEADER.unpack_from(self.mmap, offset)
+            start = offset + RECORD_HEADER.size
+            if start + length > size:
+                break
+            if kind == DEFINE:
+                self.channels[channel_id] = tuple(json.loads(self.mmap[start:start + length]))
+            else:
+                times.append(timestamp)
+                channel_ids.append(channel_id)
+                kinds.append(kind)
+                offsets.append(start)
+                lengths.append(length)
+            offset += padded(RECORD_HEADER.size + length)
+
+        self.times = np.frombuffer(times, dtype='d') if times else np.zeros(0)
+        self.channel_ids = np.array(channel_ids, dtype=int)
+        self.kinds = np.array(kinds, dtype=int)
+        self.offsets = np.array(offsets, dtype=int)
+        self.lengths = np.array(lengths, dtype=int)
+
+    def __len__(self):
+        return len(self.times)
+
+    def value(self, i):
+        start = self.offsets[i]
+        return decode(self.kinds[i], self.mmap[start:start + self.lengths[i]])
+
+    def scalars(self, rows, dtype):
+        # Gather 8 byte payloads straight from the mapped file
+        data = np.frombuffer(self.mmap, dtype=np.uint8)
+        return data[self.offsets[rows][:, None] + np.arange(8)].view(dtype).ravel()
+
+
+class LogReader(object):
+
+    # Reads every segment of a log directory, or a list of segment files
+
+    def __init__(self, path):
+        paths = segment_paths(path) if isinstance(path, basestring) else path
+        self.segments = [LogSegment(p) for p in paths]
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def channels(self):
+        channels = set()
+        for segment in self.segments:
+            channels.update(segment.channels.itervalues())
+        return sorted(channels)
+
+    def _channel_id(self, segment, channel):
+        for channel_id, name in segment.channels.iteritems():
+            if name == tuple(channel):
+                return channel_id
+
+    def records(self, channels=None, start=None, end=None):
+        # (time, channel, value) in recorded order, for some channels and times
+        channels = set(tuple(channel) for channel in channels) if channels else None
+        for segment in self.segments:
+            rows = np.ones(len(segment), dtype=bool)
+            if start is not None:
+                rows &= segment.times >= start
+            if end is not None:
+                rows &= segment.times < end
+            if channels is not None:
+                ids = [i for i, channel in segment.channels.iteritems() if channel in channels]
+                rows &= np.in1d(segment.channel_ids, ids)
+            for i in np.flatnonzero(rows):
+                yield segment.times[i], segment.channels[segment.channel_ids[i]], segment.value(i)
+
+    def to_numpy(self, channel):
+        # Structured array of (time, value) for one channel.  Numbers and same shaped
+        # arrays load into typed columns, anything else into an object column.
+        times, values, kinds = [], [], set()
+        for segment in self.segments:
+            channel_id = self._channel_id(segment, channel)
+            if channel_id is None:
+                continue
+            rows = np.flatnonzero(segment.channel_ids == channel_id)
+            times.append(segment.times[rows])
+            segment_kinds = set(segment.kinds[rows])
+            kinds.update(segment_kinds)
+            if segment_kinds == set([FLOAT]):
+                values.append(segment.scalars(rows, '<f8'))
+            elif segment_kinds == set([INT]):
+                values.append(segment.scalars(rows, '<i8'))
+            else:
+                values.append([segment.value(i) for i in rows])
+
+        times = np.concatenate(times) if times else np.zeros(0)
+        if kinds <= set([FLOAT, INT]):
+            column = np.concatenate(values).astype(float if FLOAT in kinds else int) if values else np.zeros(0)
+            shape = ()
+        else:
+            items = [value for chunk in values for value in chunk]
+            column = None
+            if kinds == set([ARRAY]) and len(set((item.dtype, item.shape) for item in items)) == 1:
+                column = np.array(items)
+            if column is None:
+                column = np.empty(len(items), dtype=object)
+                column[:] = items
+            shape = column.shape[1:]
+        result = np.empty(len(times), dtype=[('time', 'f8'), ('value', column.dtype, shape)])
+        result['time'] = times
+        result['value'] = column
+        return result
+
+    def to_frames(self, bindings, times=None):
+        # Columns for OrderedConditionSets.match_frames from channels of numbers,
+        # bindings is variable -> channel.  Frames are at times, by default every time
+        # any bound channel was put, each column holding its channel's latest value
+        # then, or NaN before its first.  Returns (times, columns).
+        recorded = dict((variable, self.to_numpy(channel)) for variable, channel in bindings.iteritems())
+        if times is None:
+            times = np.unique(np.concatenate([values['time'] for values in recorded.values()]))
+        columns = {}
+        for variable, values in recorded.iteritems():
+            order = np.argsort(values['time'], kind='mergesort')
+            channel_times = values['time'][order]
+            column = values['value'][order].astype(float)
+            latest = np.searchsorted(channel_times, times, side='right') - 1
+            columns[variable] = np.where(latest >= 0, column[np.maximum(latest, 0)], np.nan)
+        return times, columns
+
+
+class ChannelRecorder(PyroNode):
+
+    # Node that logs every put to its broker's channels matching pattern, pushed to
+    # it in batches by a subscription.  The broker queues values for it without
+    # bound unless max_pending is set, and then counts the ones it drops in its
+    # pn_stats subscriptions.
+
+    def __init__(self, directory, pattern=('*', '*'), segment_size=64 << 20, max_pending=None, **kwargs):
+        PyroNode.__init__(self, **kwargs)
+        self.log = LogWriter(directory, segment_size)
+        self.sub_id = self.subscribe(pattern, self.log.write_many, batch=True, max_pending=max_pending)
+
+    def close(self):
+        self.unsubscribe(self.sub_id)
+        self.log.close()
+
+
+class ReplaySource(object):
+
+    # Puts a recording back into a broker, at the recorded pace divided by speed, or
+    # as fast as it goes with speed None.  Values due together go in one pn_put_many.
+    # The broker stamps them with the time they are replayed, as for live puts.
+
+    def __init__(self, log, broker, speed=1., channels=None, start=None, end=None, batch=1000):
+        self.log = LogReader(log) if isinstance(log, basestring) else log
+        self.broker = PyroNode.get_proxy(broker) or broker
+        self.speed = speed
+        self.channels = channels
+        self.start_time = start
+        self.end_time = end
+        self.batch = batch
+        self.replayed = 0
+        self.thread = None
+        self.stopped = False
+
+    def run(self):
+        begin = monotonic()
+        first = None
+        items = []
+        for timestamp, channel, value in self.log.records(self.channels, self.start_time, self.end_time):
+            if self.stopped:
+                break
+            if first is None:
+                first = timestamp
+            if self.speed:
+                wait = begin + (timestamp - first) / self.speed - monotonic()
+                if wait > 0:
+                    self._put(items)
+                    time.sleep(wait)
+            items.append((value, channel))
+            if len(items) >= self.batch:
+                self._put(items)
+        self._put(items)
+        return self.replayed
+
+    def _put(self, items):
+        if items:
+            self.broker.pn_put_many(list(items))
+            self.replayed += len(items)
+            del items[:]
+
+    def start(self):
+        def replay():
+            try:
+                self.run()
+            except Exception:
+                logging.getLogger('ReplaySource').exception('Replay failed')
+        self.thread = threading.Thread(target=replay)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+
+
+def test_channel_log():
+
+    import shutil
+    import tempfile
+    from SatisfiableSet import OrderedConditionSets, VariableRegistry
+
+    directory = tempfile.mkdtemp()
+    try:
+        writer = LogWriter(directory, segment_size=512)
+        for i in range(40):
+            writer.write(100. + i, ('bed1', 'hr'), 60 + i)
+            if i % 2:
+                writer.write(100.5 + i, ('bed1', 'spo2'), 99. - i / 2.)
+            if i % 10 == 0:
+                writer.write(100. + i, ('bed1', 'ecg'), np.arange(4, dtype=np.int16) + i)
+                writer.write(100. + i, ('bed1', 'alerts'), {'rule': i, 'value': np.float64(1.5)})
+        writer.close()
+
+        log = LogReader(directory)
+        assert(len(log.segments) > 1 and len(log) == 40 + 20 + 4 + 4)
+        assert(log.channels() == [('bed1', 'alerts'), ('bed1', 'ecg'), ('bed1', 'hr'), ('bed1', 'spo2')])
+
+        hr = log.to_numpy(('bed1', 'hr'))
+        assert(list(hr['value']) == range(60, 100) and hr['value'].dtype == int)
+        assert(log.to_numpy(('bed1', 'ecg'))['value'].shape == (4, 4))
+        assert(log.to_numpy(('bed1', 'alerts'))['value'][1] == {'rule': 10, 'value': 1.5})
+        records = list(log.records([('bed1', 'spo2')], start=110, end=120))
+        assert([value for t, channel, value in records] == [93.5, 92.5, 91.5, 90.5, 89.5])
+
+        # Batch run of rules over the recording
+        times, frames = log.to_frames({'hr': ('bed1', 'hr'), 'spo2': ('bed1', 'spo2')})
+        assert(len(times) == 60 and np.isnan(frames['spo2'][0]))
+        with VariableRegistry('replay'):
+            rules = OrderedConditionSets([{'hr': ('GT', 90), 'spo2': ('LT', 85)}, {'hr': ('GT', 80)}])
+            matches = rules.match_frames(frames)
+        assert(matches[-1] == 0 and matches[0] == -1 and (matches == 1).any())
+
+        class Broker(object):
+            def __init__(self):
+                self.calls = []
+            def pn_put_many(self, items):
+                self.calls.append(items)
+
+        broker = Broker()
+        assert(ReplaySource(log, broker, speed=None).run() == len(log))
+        assert(sum(len(items) for items in broker.calls) == len(log) and len(broker.calls) == 1)
+
+        broker = Broker()
+        begin = time.time()
+        ReplaySource(log, broker, speed=400., channels=[('bed1', 'hr')]).run()
+        assert(0.08 < time.time() - begin < 0.5 and len(broker.calls) > 10)
+
+        # Recorder on a broker's pushes
+        source = PyroNode(pn_id='log_broker', register=False)
+        recorder = ChannelRecorder(os.path.join(directory, 'live'), pn_id='log_recorder',
+                                   broker='log_broker', register=False)
+        recorder.log._open_segment()
+        assert(source.pn_subscriptions[recorder.sub_id].pending.maxlen is None)
+        for i in range(100):
+            source.pn_put(float(i), ('bed2', 'hr'))
+        for i in range(100):
+            if recorder.log.records == 100:
+                break
+            time.sleep(0.01)
+        recorder.close()
+        assert(list(LogReader(os.path.join(directory, 'live')).to_numpy(('bed2', 'hr'))['value']) == range(100))
+
+        # Later writers start after the last segment, even with one missing
+        live = os.path.join(directory, 'live')
+        os.remove(os.path.join(live, 'segment-000000.log'))
+        writer = LogWriter(live)
+        writer.write(1., ('bed2', 'hr'), 100.)
+        writer.close()
+        assert([segment_index(path) for path in segment_paths(live)] == [1, 2])
+        assert(len(LogReader(live)) == 101)
+
+        # Reading while a writer is going, with a segment header not yet on disk
+        writer = LogWriter(os.path.join(directory, 'open'))
+        writer.write(1., ('bed3', 'hr'), 70)
+        assert(len(LogReader(os.path.join(directory, 'open'))) == 0)
+        open(os.path.join(directory, 'open', 'segment-000001.log'), 'wb').write(MAGIC[:4])
+        assert(len(LogReader(os.path.join(directory, 'open'))) == 0)
+        writer.flush()
+        assert(len(LogReader(os.path.join(directory, 'open'))) == 1)
+        writer.close()
+    finally:
+        shutil.rmtree(directory)
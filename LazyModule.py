@@ -0,0 +1,104 @@
+# Stand-in for a module that is only imported when first used, so importing a duppy
+# module doesn't pay for dependencies that a process never touches, ie:
+#
+#   np = LazyModule('numpy')
+#
+# Once loaded, the module's names are copied onto the stand-in, so later lookups are
+# plain attribute reads.
+
+import importlib
+import inspect
+import threading
+
+
+class LazyModule(object):
+
+    # Shared, and reentrant for on_load hooks that use other lazy modules
+    _lock = threading.RLock()
+
+    def __init__(self, name, on_load=None):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+        # Called with the module after the first import, ie, to register hooks
+        self.__dict__['_lazy_on_load'] = on_load
+
+    def _lazy_load(self):
+        with self._lock:
+            module = self.__dict__['_lazy_module']
+            if module is None:
+                module = importlib.import_module(self._lazy_name)
+                self.__dict__.update(module.__dict__)
+                self.__dict__['_lazy_module'] = module
+                if self._lazy_on_load:
+                    self._lazy_on_load(module)
+        return module
+
+    @property
+    def loaded(self):
+        return self.__dict__['_lazy_module'] is not None
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_load(), name, value)
+        self.__dict__[name] = value
+
+    def __repr__(self):
+        return '<LazyModule {0}{1}>'.format(self._lazy_name, '' if self.loaded else ' (not loaded)')
+
+
+class lazy_class_attribute(object):
+
+    # Class attribute made by func(cls) on first access and then stored on the class
+    # in place of this, ie, for anything that shouldn't happen at import
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.lock = threading.Lock()
+
+    def __get__(self, obj, cls):
+        with self.lock:
+            for owner in inspect.getmro(cls):
+                if owner.__dict__.get(self.__name__) is self:
+                    value = self.func(owner)
+                    setattr(owner, self.__name__, value)
+                    return value
+        # Made by another thread meanwhile
+        return getattr(cls, self.__name__)
+
+
+def test_lazy_module():
+
+    import sys
+    name = 'wave'
+    sys.modules.pop(name, None)
+    loaded = []
+    wave = LazyModule(name, on_load=loaded.append)
+    assert(not wave.loaded and name not in sys.modules)
+    assert(wave.Error is sys.modules[name].Error)
+    assert(wave.loaded and loaded == [sys.modules[name]])
+    assert('Error' in wave.__dict__)
+    wave.Error
+    assert(len(loaded) == 1)
+
+
+def test_lazy_class_attribute():
+
+    calls = []
+
+    class Node:
+        @lazy_class_attribute
+        def host(cls):
+            calls.append(cls)
+            return 'localhost'
+
+    class SubNode(Node):
+        pass
+
+    assert(not calls)
+    assert(SubNode().host == 'localhost' and Node.host == 'localhost')
+    assert(calls == [Node] and Node.__dict__['host'] == 'localhost')
+    Node.host = '10.0.0.1'
+    assert(SubNode.host == '10.0.0.1')
@@ -1,14 +1,40 @@
 # Implements a simple Pyro4 network with data brokers, sinks, and sources
 
+import base64
 import logging
+import mmap
+import os
+import tempfile
 # logging.basicConfig()  # or your own sophisticated setup
 # logging.getLogger("Pyro4").setLevel(logging.DEBUG)
 # logging.getLogger("Pyro4.core").setLevel(logging.DEBUG)
 # import os
-import Pyro4
-import numpy as np
 import time
 import threading
+import itertools
+import socket
+import heapq
+import json
+import atexit
+import hashlib
+import bisect
+import Queue
+from collections import deque
+from fnmatch import fnmatchcase
+from LazyModule import LazyModule, lazy_class_attribute
+from SatisfiableSet import VariableRegistry, OrderedConditionSets, ConditionSetMonitor
+
+
+# Importing this module shouldn't touch the network or load Pyro4 and numpy, so they
+# load on first use, and the array codecs are registered with Pyro4 when it loads
+def register_codecs(Pyro4):
+    Pyro4.util.SerializerBase.register_class_to_dict(bytearray, bytearray_to_dict)
+    Pyro4.util.SerializerBase.register_class_to_dict(np.ndarray, ndarray_to_dict)
+    Pyro4.util.SerializerBase.register_dict_to_class('numpy.ndarray', dict_to_ndarray)
+
+Pyro4 = LazyModule('Pyro4', on_load=register_codecs)
+serpent = LazyModule('serpent')
+np = LazyModule('numpy')
 
 # Doesn't like this argument on Windows
 #Pyro4.config.SOCK_REUSE = True
@@ -34,18 +60,1056 @@ def get_host_name():
     return host
 
 
+# Deadlines need a clock that never steps; python 2 has no time.monotonic, so
+# ask the C library, and settle for wall time if that fails.  The library is
+# opened by name rather than with ctypes.util.find_library, which runs ldconfig
+# in a subprocess, so importing this stays cheap.
+def get_monotonic_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    import ctypes
+    import sys
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_id = {'linux2': 1, 'darwin': 6}.get(sys.platform)
+    clock_gettime = None
+    # Symbols already loaded in this process, then the older home of clock_gettime
+    for library in [None, 'librt.so.1']:
+        try:
+            clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+            break
+        except (OSError, AttributeError):
+            pass
+    if clock_gettime is None:
+        clock_id = None
+    if clock_id is None:
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        # One struct per call, the GIL is released while clock_gettime fills it
+        t = timespec()
+        clock_gettime(clock_id, ctypes.byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = get_monotonic_clock()
+
+
+# The default serializers can't carry numpy arrays, ie, waveforms or channel
+# histories, so send them as their raw bytes with a dtype and shape header.  Marshal
+# passes the bytes through as is, serpent base64 encodes them; either is far cheaper
+# than lists.  The receiver wraps the bytes with np.frombuffer rather than copying,
+# so arrays may arrive read-only.  Object arrays still go as lists.
+def ndarray_to_dict(array):
+    if array.dtype.hasobject:
+        if array.dtype.names:
+            return {'__class__': 'numpy.ndarray',
+                    'dtype': array.dtype.descr,
+                    'length': len(array),
+                    'data': [array[name].tolist() for name in array.dtype.names]}
+        return {'__class__': 'numpy.ndarray',
+                'dtype': array.dtype.str,
+                'data': array.tolist()}
+    return {'__class__': 'numpy.ndarray',
+            'dtype': array.dtype.descr if array.dtype.names else array.dtype.str,
+            'shape': array.shape,
+            'bytes': bytearray(np.ascontiguousarray(array).data)}
+
+
+def decode_dtype(spec):
+    if isinstance(spec, basestring):
+        return np.dtype(str(spec))
+    # Field specs may come back as lists
+    return np.dtype([(str(field[0]), str(field[1])) + tuple(tuple(x) for x in field[2:])
+                     for field in spec])
+
+
+def dict_to_ndarray(classname, d):
+    dtype = decode_dtype(d['dtype'])
+    if 'bytes' in d:
+        data = d['bytes']
+        if isinstance(data, dict):
+            # base64 from serpent or json
+            data = serpent.tobytes(data)
+        return np.frombuffer(data, dtype=dtype).reshape(tuple(d['shape']))
+    if 'length' in d:
+        array = np.empty(d['length'], dtype=dtype)
+        for name, column in zip(array.dtype.names, d['data']):
+            array[name] = column
+        return array
+    return np.array(d['data'], dtype=dtype)
+
+
+def bytearray_to_dict(data):
+    # For json, which has no bytes type; same form as serpent uses
+    return {'data': base64.b64encode(data), 'encoding': 'base64'}
+
+
+
+class LatencyHistogram(object):
+
+    # Counts of durations in power of 2 buckets from 1us up, so recording is a bisect
+    # and an increment.  Percentiles are bucket upper bounds, ie, within a factor of 2.
+    # Counters aren't locked; concurrent records may very rarely lose a count.
+
+    bounds = [1e-6 * 2 ** i for i in range(25)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, duration):
+        self.counts[bisect.bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        target = q / 100. * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+
+class RateCounter(object):
+
+    __slots__ = ('count', 'first', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.first = None
+        self.last = None
+
+    def add(self, now, n=1):
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.count += n
+
+    def rate(self):
+        # Mean rate per second since the first add
+        if self.count > 1 and self.last > self.first:
+            return self.count / (self.last - self.first)
+
+
+class ChannelBuffer(object):
+
+    # Bounded (timestamp, value) history for one channel.  The value buffer is
+    # preallocated on the first put from that value's shape and dtype, and widened
+    # if later values don't fit, ie, ints then floats, or ragged waveform chunks.
+    # seq counts every put, so a reader can ask for everything since the last seq
+    # it saw and tell from the first seq returned whether it fell behind.
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.seq = 0
+        self.times = np.zeros(capacity)
+        self.values = None
+        self.latest = None
+        self.latest_time = None
+
+    def _store(self, i, value):
+        if self.values is None:
+            array = np.asarray(value)
+            if array.dtype.kind in 'biuf':
+                self.values = np.zeros((self.capacity,) + array.shape, dtype=array.dtype)
+            else:
+                self.values = np.empty(self.capacity, dtype=object)
+        elif self.values.dtype != object:
+            array = np.asarray(value)
+            if array.shape != self.values.shape[1:] or array.dtype.kind not in 'biuf':
+                values = np.empty(self.capacity, dtype=object)
+                for j in range(self.capacity):
+                    values[j] = self.values[j]
+                self.values = values
+            elif not np.can_cast(array.dtype, self.values.dtype):
+                self.values = self.values.astype(np.result_type(array.dtype, self.values.dtype))
+        self.values[i] = value
+
+    def put(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        i = self.seq % self.capacity
+        self._store(i, value)
+        self.times[i] = timestamp
+        self.latest = value
+        self.latest_time = timestamp
+        # Only publish the seq once the slot is written
+        self.seq += 1
+
+    def get_since(self, seq=None, timestamp=None):
+        # Structured array of (seq, time, value) for every buffered put with a seq of
+        # at least seq and a time after timestamp, oldest first
+        end = self.seq
+        start = max(end - self.capacity, seq or 0)
+        if self.values is None or start >= end:
+            return np.zeros(0, dtype=[('seq', 'i8'), ('time', 'f8'), ('value', 'f8')])
+        seqs = np.arange(start, end)
+        slots = seqs % self.capacity
+        times = self.times[slots]
+        if timestamp is not None:
+            first = np.searchsorted(times, timestamp, side='right')
+            seqs, slots, times = seqs[first:], slots[first:], times[first:]
+        result = np.empty(len(seqs), dtype=[('seq', 'i8'), ('time', 'f8'),
+                                            ('value', self.values.dtype, self.values.shape[1:])])
+        result['seq'] = seqs
+        result['time'] = times
+        result['value'] = self.values[slots]
+        return result
+
+    def __len__(self):
+        return min(self.seq, self.capacity)
+
+    def rate(self):
+        # Recent put rate per second, over the buffered puts
+        n = len(self)
+        if n > 1:
+            span = self.times[(self.seq - 1) % self.capacity] - self.times[(self.seq - n) % self.capacity]
+            if span > 0:
+                return (n - 1) / span
+
+
+class SharedChannel(object):
+
+    # A channel's ring buffer in a memory mapped file, ie, under /dev/shm, so sinks
+    # on the same host can read it without going through the broker.  The broker is
+    # the only writer.  Each slot carries the seq of its value, set to -1 while the
+    # slot is being written, and readers check it before and after copying a slot
+    # and skip it if it changed, so readers never wait on or block the writer.  Seqs
+    # match the broker's ChannelBuffer, and rows are laid out like its get_since.
+
+    @lazy_class_attribute
+    def header_dtype(cls):
+        return np.dtype([('magic', 'S8'), ('seq', 'i8'), ('closed', 'i8'), ('capacity', 'i8'),
+                         ('dtype', 'S16'), ('ndim', 'i8'), ('shape', 'i8', (4,))])
+
+    header_size = 128
+    magic = 'PYRONODE'
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    def __init__(self, path, writer=False):
+        self.path = path
+        self.writer = writer
+        with open(path, 'r+b' if writer else 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writer else mmap.ACCESS_READ)
+        header = np.frombuffer(self.mmap, dtype=self.header_dtype, count=1)
+        if header['magic'][0] != self.magic:
+            raise ValueError('Not a shared channel: {0}'.format(path))
+        self.header = header
+        self.capacity = int(header['capacity'][0])
+        self.dtype = np.dtype(header['dtype'][0])
+        self.shape = tuple(header['shape'][0][:header['ndim'][0]])
+        self.row_dtype = np.dtype([('seq', 'i8'), ('time', 'f8'), ('value', self.dtype, self.shape)])
+        self.rows = np.frombuffer(self.mmap, dtype=self.row_dtype, count=self.capacity, offset=self.header_size)
+
+    @classmethod
+    def create(cls, name, capacity, dtype, shape=(), seq=0):
+        dtype = np.dtype(dtype)
+        header = np.zeros(1, dtype=cls.header_dtype)
+        header['magic'] = cls.magic
+        header['seq'] = seq
+        header['capacity'] = capacity
+        header['dtype'] = dtype.str
+        header['ndim'] = len(shape)
+        header['shape'][0][:len(shape)] = shape
+        row_dtype = np.dtype([('seq', 'i8'), ('time', 'f8'), ('value', dtype, shape)])
+        path = os.path.join(cls.directory, name)
+        with open(path, 'wb') as f:
+            f.write(header.tobytes().ljust(cls.header_size, '\0'))
+            f.truncate(cls.header_size + capacity * row_dtype.itemsize)
+        shared = cls(path, writer=True)
+        shared.rows['seq'] = -1
+        return shared
+
+    @property
+    def seq(self):
+        return int(self.header['seq'][0])
+
+    @property
+    def closed(self):
+        return bool(self.header['closed'][0])
+
+    def fits(self, dtype, shape):
+        return self.dtype == dtype and self.shape == tuple(shape)
+
+    def put(self, value, timestamp):
+        seq = self.seq
+        i = seq % self.capacity
+        rows = self.rows
+        rows['seq'][i] = -1
+        rows['time'][i] = timestamp
+        rows['value'][i] = value
+        rows['seq'][i] = seq
+        self.header['seq'] = seq + 1
+
+    def get_since(self, seq=None):
+        end = self.seq
+        start = max(end - self.capacity, seq or 0)
+        if start >= end:
+            return np.zeros(0, dtype=self.row_dtype)
+        seqs = np.arange(start, end)
+        slots = seqs % self.capacity
+        rows = self.rows[slots]
+        # Keep the rows that weren't being rewritten while copied
+        valid = (rows['seq'] == seqs) & (self.rows['seq'][slots] == seqs)
+        return rows if valid.all() else rows[valid]
+
+    def latest(self, with_time=False):
+        # Latest value, or (time, value) with_time
+        rows = self.get_since(self.seq - 1)
+        if len(rows):
+            value = rows['value'][-1]
+            value = value.item() if not self.shape else value
+            return (float(rows['time'][-1]), value) if with_time else value
+        return (None, None) if with_time else None
+
+    def close(self):
+        # Readers see closed and go back to asking the broker
+        if self.writer:
+            self.header['closed'] = 1
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class RuleStage(object):
+
+    # Rules a broker evaluates as values are put, ie, so sinks get alarms rather than
+    # every sample.  rules are as for OrderedConditionSets, bindings map each variable
+    # to the channel it's read from.  Each put to a bound channel updates a
+    # ConditionSetMonitor, and alerts are put to the alerts channel, in 'transitions'
+    # mode when the first matching rule changes, or in 'matches' mode on every put
+    # while a rule matches.  Alerts are dicts with the rule index and name, the
+    # previous rule, and the channel, value and time of the put that caused them.
+    # Bound channels can have different sources, so their puts arrive on different
+    # daemon threads; lock serializes them through the monitor and the alerts.
+
+    def __init__(self, node, rules_id, rules, bindings, alerts_channel, mode='transitions',
+                 names=None, record_history=False):
+        if mode not in ('transitions', 'matches'):
+            raise ValueError('Unknown rule mode: {0}'.format(mode))
+        self.node = node
+        self.rules_id = rules_id
+        self.alerts_channel = tuple(alerts_channel)
+        self.mode = mode
+        self.names = names
+        self.bindings = dict((tuple(channel), variable) for variable, channel in bindings.iteritems())
+        self.registry = VariableRegistry(rules_id)
+        self.monitor = ConditionSetMonitor(OrderedConditionSets(rules, registry=self.registry),
+                                           record_history=record_history)
+        if record_history:
+            for variable in bindings:
+                if variable in self.registry.variables:
+                    self.registry.variables[variable].track()
+        self.monitor.callbacks.append(self._transition)
+        # Reentrant in case the stage's alerts channel is bound to its own rules
+        self.lock = threading.RLock()
+        self._put = None
+        # Counters
+        self.evaluated = 0
+        self.published = 0
+        self.errors = 0
+
+    def name(self, rule):
+        if rule is not None and self.names:
+            return self.names[rule]
+
+    def _alert(self, rule, previous):
+        channel, value, timestamp = self._put
+        # Stages sharing an alerts channel write it from their own threads, so take
+        # turns, as a channel's buffer expects a single writer
+        lock = self.node._alert_locks.setdefault(self.alerts_channel, threading.RLock())
+        with lock:
+            self._publish_alert(rule, previous, channel, value, timestamp)
+
+    def _publish_alert(self, rule, previous, channel, value, timestamp):
+        self.node.pn_put({'rules': self.rules_id,
+                          'rule': rule,
+                          'name': self.name(rule),
+                          'previous': previous,
+                          'previous_name': self.name(previous),
+                          'channel': list(channel),
+                          'value': value,
+                          'time': timestamp}, self.alerts_channel)
+        self.published += 1
+
+    def _transition(self, previous, current):
+        if self.mode == 'transitions':
+            self._alert(current, previous)
+
+    def on_put(self, channel, value, timestamp):
+        with self.lock:
+            self._put = (channel, value, timestamp)
+            self.evaluated += 1
+            try:
+                previous = self.monitor.current
+                current = self.monitor.update(self.bindings[channel], value, timestamp)
+            except Exception:
+                self.errors += 1
+                logging.getLogger('RuleStage').exception('Rules {0} failed on {1}'.format(self.rules_id, channel))
+                return
+            if self.mode == 'matches' and current is not None:
+                self._alert(current, previous)
+
+    def stats(self):
+        return {'rules': len(self.monitor.condition_sets.condition_sets),
+                'channels': [list(channel) for channel in self.bindings],
+                'alerts_channel': list(self.alerts_channel),
+                'mode': self.mode,
+                'current': self.monitor.current,
+                'evaluated': self.evaluated,
+                'published': self.published,
+                'errors': self.errors}
+
+
+class Subscription(object):
+
+    # Broker-side state for one subscriber.  New values queue up in pending (at most
+    # max_pending, oldest dropped, or unbounded with None) and are shipped to the subscriber's pn_notify as one list per
+    # call, at most max_rate calls/sec.  With latest_only, only the newest value per
+    # channel is kept between deliveries.  scheduled makes sure only one dispatch
+    # thread serves a subscription at a time, so delivery order is kept.
+
+    def __init__(self, sub_id, subscriber, pattern, max_rate=None, latest_only=False, max_pending=10000):
+        self.sub_id = sub_id
+        self.subscriber = subscriber
+        self.pattern = tuple(pattern)
+        self.max_rate = max_rate
+        self.latest_only = latest_only
+        self.pending = deque(maxlen=max_pending)
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.next_delivery = 0
+        self.proxy = None
+        self.delivered = 0
+        self.dropped = 0
+        self.failures = 0
+
+    def matches(self, channel):
+        # Channel keys are tuples, each element may be an fnmatch pattern
+        if len(channel) != len(self.pattern):
+            return False
+        for key, pattern in zip(channel, self.pattern):
+            if key != pattern and not fnmatchcase(str(key), str(pattern)):
+                return False
+        return True
+
+    def take(self):
+        # Items to send now, or a delay to wait first for the rate limit
+        wait = self.next_delivery - time.time()
+        if wait > 0:
+            return None, wait
+        items = list(self.pending)
+        self.pending.clear()
+        if self.latest_only:
+            latest = {}
+            for item in items:
+                latest[item[0]] = item
+            items = sorted(latest.values(), key=lambda item: item[2])
+        if self.max_rate:
+            self.next_delivery = time.time() + 1. / self.max_rate
+        return items, 0
+
+
+class DispatchPool(object):
+
+    # Small thread pool that delivers subscription updates.  A slow or dead subscriber
+    # ties up at most one thread while the others keep delivering.
+
+    def __init__(self, threads=4):
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def schedule(self, subscription):
+        # Caller holds subscription.lock
+        if not subscription.scheduled:
+            subscription.scheduled = True
+            self.queue.put(subscription)
+
+    def _work(self):
+        while 1:
+            subscription = self.queue.get()
+            try:
+                self._deliver(subscription)
+            except Exception:
+                logging.getLogger('DispatchPool').exception('Delivery to %s failed' % subscription.subscriber)
+
+    def _deliver(self, subscription):
+        with subscription.lock:
+            items, wait = subscription.take()
+        if items is None:
+            timer = threading.Timer(wait, self.queue.put, (subscription,))
+            timer.setDaemon(True)
+            timer.start()
+            return
+        try:
+            if items:
+                if subscription.proxy is None:
+                    subscription.proxy = PyroNode.get_proxy(subscription.subscriber)
+                subscription.proxy.pn_notify(subscription.sub_id, items)
+                subscription.delivered += len(items)
+        except Exception:
+            subscription.failures += 1
+            subscription.dropped += len(items)
+            subscription.proxy = None
+            raise
+        finally:
+            with subscription.lock:
+                if subscription.pending:
+                    self.queue.put(subscription)
+                else:
+                    subscription.scheduled = False
+
+
+class PooledProxy(object):
+
+    # Thread-safe stand-in for a Pyro proxy to a named node.  Pyro proxies can't be
+    # shared between threads, so each thread calling through this gets its own,
+    # bound once and then reused.  Remote methods are looked up by attribute as on a
+    # proxy.  A failure to connect is retried once on a fresh name server lookup, in
+    # case the node moved.  A call that fails after connecting may have run, so it's
+    # only retried for read-only methods; others raise, and the next call reconnects.
+
+    read_only = frozenset(['pn_get', 'pn_get_many', 'pn_get_since', 'pn_channels', 'pn_shared_channel',
+                           'pn_stats', 'pn_rules_stats'])
+
+    def __init__(self, pool, name, oneway=()):
+        self._pool = pool
+        self._name = name
+        # Sent oneway by this handle, other handles share the connections
+        self._oneway = set(oneway)
+
+    def _proxy(self, refresh=False):
+        proxies = self._pool.local_proxies()
+        entry = proxies.get(self._name)
+        if refresh or entry is None:
+            if entry is not None:
+                entry[0]._pyroRelease()
+            proxy = Pyro4.Proxy(self._pool.lookup(self._name, refresh=refresh))
+            proxy._pyroBind()
+            # Oneway and regular calls now share a connection, and without nodelay a
+            # request written right after a oneway call waits on the delayed ack
+            proxy._pyroConnection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            entry = proxies[self._name] = [proxy]
+        return entry[0]
+
+    def _discard(self):
+        # Forget a broken connection and where the node was
+        entry = self._pool.local_proxies().pop(self._name, None)
+        if entry is not None:
+            entry[0]._pyroRelease()
+        self._pool.invalidate(self._name)
+
+    def set_oneway(self, *methods):
+        self._oneway.update(methods)
+
+    def with_oneway(self, *methods):
+        # Handle to the same node with methods oneway, leaving this one as it is
+        return PooledProxy(self._pool, self._name, self._oneway.union(methods))
+
+    def _invoke(self, proxy, method, args, kwargs):
+        if method in self._oneway:
+            return proxy._pyroInvoke(method, args, kwargs, Pyro4.message.FLAGS_ONEWAY)
+        return getattr(proxy, method)(*args, **kwargs)
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            try:
+                proxy = self._proxy()
+            except Pyro4.errors.CommunicationError:
+                # Nothing sent yet
+                self._pool.logger.debug('Reconnecting to {0}'.format(self._name))
+                proxy = self._proxy(refresh=True)
+            try:
+                return self._invoke(proxy, method, args, kwargs)
+            except Pyro4.errors.CommunicationError:
+                if method not in PooledProxy.read_only:
+                    self._discard()
+                    raise
+                self._pool.logger.debug('Reconnecting to {0}'.format(self._name))
+                return self._invoke(self._proxy(refresh=True), method, args, kwargs)
+        call.__name__ = method
+        return call
+
+    def __repr__(self):
+        return '<PooledProxy {0}>'.format(self._name)
+
+
+class LocalProxy(object):
+
+    # Stand-in for a proxy to a node in this process.  Calls go straight to the node
+    # with no name server, socket or serializer, but otherwise as they would remotely:
+    # only public methods, and oneway methods return None and swallow errors.  Values
+    # are passed by reference, so a source shouldn't modify a value after putting it.
+
+    def __init__(self, node, name=None, oneway=()):
+        self._node = node
+        self._name = name
+        self._oneway = set(oneway)
+
+    def set_oneway(self, *methods):
+        for method in methods:
+            self._oneway.add(method)
+            self.__dict__.pop(method, None)
+
+    def with_oneway(self, *methods):
+        return LocalProxy(self._node, self._name, self._oneway.union(methods))
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        func = getattr(self._node, method)
+        if method in self._oneway:
+            def call(*args, **kwargs):
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    logging.getLogger('LocalProxy').exception('Oneway call to {0}.{1} failed'.format(self._name, method))
+        else:
+            call = func
+        # Look it up once
+        self.__dict__[method] = call
+        return call
+
+    def __repr__(self):
+        return '<LocalProxy {0}>'.format(self._name)
+
+
+class ProxyPool(object):
+
+    # Name server lookups, cached for ttl seconds, and the PooledProxy for each node
+    # name.  The proxies themselves are kept per thread.  Nodes in this process are
+    # called through a LocalProxy instead, unless local_calls is off.
+
+    def __init__(self, ttl=60., local_calls=True):
+        self.ttl = ttl
+        self.local_calls = local_calls
+        self.uris = {}
+        self.handles = {}
+        self.nodes = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.lookups = 0
+        self.logger = logging.getLogger('ProxyPool')
+
+    def local_proxies(self):
+        try:
+            return self.local.proxies
+        except AttributeError:
+            self.local.proxies = {}
+            return self.local.proxies
+
+    def lookup(self, name, refresh=False):
+        entry = self.uris.get(name)
+        if refresh or entry is None or entry[1] < monotonic():
+            try:
+                ns = self.local.ns
+            except AttributeError:
+                ns = self.local.ns = Pyro4.locateNS()
+            try:
+                uri = ns.lookup(name)
+            except Pyro4.errors.CommunicationError:
+                # The name server itself may have moved
+                ns = self.local.ns = Pyro4.locateNS()
+                uri = ns.lookup(name)
+            self.lookups += 1
+            entry = self.uris[name] = (uri, monotonic() + self.ttl)
+        return entry[0]
+
+    def get(self, name):
+        handle = self.handles.get(name)
+        if handle is None:
+            with self.lock:
+                handle = self.handles.get(name)
+                if handle is None:
+                    if self.local_calls and name in self.nodes:
+                        handle = LocalProxy(self.nodes[name], name)
+                    else:
+                        handle = PooledProxy(self, name)
+                    self.handles[name] = handle
+        return handle
+
+    def add_local(self, name, node):
+        # Proxies handed out from now on call node directly
+        with self.lock:
+            self.nodes[name] = node
+            self.handles.pop(name, None)
+
+    def invalidate(self, name=None):
+        if name is None:
+            self.uris.clear()
+        else:
+            self.uris.pop(name, None)
+
+
+class ScheduledTask(object):
+
+    def __init__(self, func, period, name=None):
+        self.func = func
+        self.period = period
+        self.name = name or getattr(func, '__name__', 'task')
+        self.cancelled = False
+        self.runs = 0
+        self.errors = 0
+        # Runs that took longer than a period, and deadlines skipped because of them
+        self.overruns = 0
+        self.missed = 0
+        self.total_duration = 0.
+        self.max_duration = 0.
+        self.max_lateness = 0.
+        self.durations = LatencyHistogram()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stats(self):
+        return {'name': self.name,
+                'period': self.period,
+                'runs': self.runs,
+                'errors': self.errors,
+                'overruns': self.overruns,
+                'missed': self.missed,
+                'mean_duration': self.total_duration / self.runs if self.runs else None,
+                'max_duration': self.max_duration,
+                'max_lateness': self.max_lateness,
+                'durations': self.durations.summary()}
+
+
+class PyroScheduler(object):
+
+    # Runs periodic tasks, ie, every node's update funcs, from a single thread.  Each
+    # task has its own period.  Deadlines advance by whole periods on the monotonic
+    # clock, so loop jitter doesn't accumulate into drift, and a task that overruns
+    # skips the deadlines it missed (counted) rather than bursting to catch up.
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        # Process-wide scheduler used by PyroNode.run
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.heap = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.logger = logging.getLogger('PyroScheduler')
+        self._seq = itertools.count()
+
+    def add(self, func, period, name=None, start=None):
+        task = ScheduledTask(func, period, name)
+        with self.condition:
+            deadline = self.clock() if start is None else start
+            heapq.heappush(self.heap, (deadline, next(self._seq), task))
+            self.condition.notify()
+        return task
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run_loop(self):
+        clock = self.clock
+        while 1:
+            with self.condition:
+                while self.running:
+                    if self.heap:
+                        wait = self.heap[0][0] - clock()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self.condition.wait(wait)
+                if not self.running:
+                    return
+                deadline, seq, task = heapq.heappop(self.heap)
+            if task.cancelled:
+                continue
+
+            begin = clock()
+            try:
+                task.func()
+            except Exception:
+                task.errors += 1
+                self.logger.exception('Task %s failed' % task.name)
+            end = clock()
+
+            duration = end - begin
+            task.runs += 1
+            task.total_duration += duration
+            task.durations.record(duration)
+            task.max_duration = max(task.max_duration, duration)
+            task.max_lateness = max(task.max_lateness, begin - deadline)
+            if duration > task.period:
+                task.overruns += 1
+            # Deadlines that passed while this run was going
+            skipped = int((end - deadline) // task.period)
+            if skipped > 0:
+                task.missed += skipped
+            next_deadline = deadline + (max(skipped, 0) + 1) * task.period
+
+            with self.condition:
+                if not task.cancelled:
+                    heapq.heappush(self.heap, (next_deadline, next(self._seq), task))
+
+    def tasks(self):
+        with self.condition:
+            return [task for deadline, seq, task in self.heap]
+
+    def stats(self):
+        return [task.stats() for task in self.tasks()]
+
+
+class ShardedBroker(object):
+
+    # Spreads channels over several brokers by consistent hashing, and stands in for
+    # a broker proxy, so a node's broker can be a list of broker names.  Each broker
+    # gets a number of points on a hash ring and a channel belongs to the next point
+    # after its own hash, so adding a broker only moves the channels that land on its
+    # points.  Batched calls are split into one call per broker.
+    #
+    # Every node keeps its own ring.  add_broker migrates the buffered history of the
+    # channels that move, and calling it on the other nodes' rings too then finds
+    # nothing left to move.  Subscriptions are made on every broker, ie, for
+    # patterns, and replayed on brokers added later.  Seqs of moved channels may
+    # jump, so get_since readers of a moved channel can see a gap or a repeat.
+    # Nodes whose rings aren't updated yet keep putting to the old broker; those
+    # values start a new buffer there, which the next rebalance moves.  Reads on
+    # the new broker miss them until then.
+
+    def __init__(self, brokers=(), points=64):
+        self.points = points
+        self.brokers = {}
+        self.ring = []
+        self.hashes = []
+        self.oneway = set()
+        self.subscriptions = {}
+        self._sub_ids = itertools.count()
+        self.moved = 0
+        for broker in brokers:
+            self.add_broker(broker, migrate=False)
+
+    @staticmethod
+    def hash(key):
+        # Stable across processes, unlike hash()
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    @staticmethod
+    def channel_key(channel):
+        # Channels may come back from the serializer as lists of unicode
+        if isinstance(channel, basestring):
+            channel = (channel,)
+        return u'\x00'.join(unicode(part) for part in channel).encode('utf-8')
+
+    def _build_ring(self):
+        ring = sorted((self.hash('{0}#{1}'.format(name, i)), name)
+                      for name in self.brokers for i in range(self.points))
+        self.hashes = [h for h, name in ring]
+        self.ring = [name for h, name in ring]
+
+    def owner(self, channel):
+        # Name of the broker holding channel
+        i = bisect.bisect(self.hashes, self.hash(self.channel_key(channel)))
+        return self.ring[i % len(self.ring)]
+
+    def shard(self, channel):
+        return self.brokers[self.owner(channel)]
+
+    @staticmethod
+    def broker_name(broker):
+        # Ring points are hashed from names, so they must be the same in every process
+        if isinstance(broker, basestring):
+            return broker
+        if isinstance(broker, (PooledProxy, LocalProxy)) and broker._name:
+            return broker._name
+        if isinstance(broker, PyroNode):
+            return broker.pn_id
+        raise ValueError('No name for broker {0!r}, pass one to add_broker'.format(broker))
+
+    def add_broker(self, broker, name=None, migrate=True):
+        name = name or self.broker_name(broker)
+        proxy = PyroNode.get_proxy(broker) or broker
+        if self.oneway:
+            proxy = PyroNode.oneway_proxy(proxy, *self.oneway)
+        for args in self.subscriptions.itervalues():
+            proxy.pn_subscribe(*args)
+        self.brokers[name] = proxy
+        self._build_ring()
+        if migrate:
+            self.rebalance()
+
+    def rebalance(self):
+        # Move any channel not on its owner, returns how many moved
+        moved = 0
+        for name, proxy in self.brokers.items():
+            for channel in proxy.pn_channels():
+                owner = self.owner(channel)
+                if owner != name:
+                    # Taken off the old broker in one call, so nothing put there
+                    # between a copy and a drop is lost
+                    self.brokers[owner].pn_load(channel, proxy.pn_drop(channel))
+                    moved += 1
+        self.moved += moved
+        return moved
+
+    def set_oneway(self, *methods):
+        # Shard handles may be shared with other nodes, so swap in oneway ones
+        self.oneway.update(methods)
+        for name, proxy in self.brokers.items():
+            self.brokers[name] = PyroNode.oneway_proxy(proxy, *methods)
+
+    def _split(self, channels):
+        # Broker name -> [(index, channel)]
+        shards = {}
+        for i, channel in enumerate(channels):
+            shards.setdefault(self.owner(channel), []).append((i, channel))
+        return shards
+
+    def pn_get(self, channel):
+        return self.shard(channel).pn_get(channel)
+
+    def pn_put(self, value, channel):
+        return self.shard(channel).pn_put(value, channel)
+
+    def pn_get_since(self, channel, seq=None, timestamp=None):
+        return self.shard(channel).pn_get_since(channel, seq, timestamp)
+
+    def pn_shared_channel(self, channel):
+        return self.shard(channel).pn_shared_channel(channel)
+
+    def pn_stats(self):
+        return dict((name, proxy.pn_stats()) for name, proxy in self.brokers.iteritems())
+
+    def pn_attach_rules(self, rules_id, rules, bindings, *args):
+        # Rules are evaluated by the broker holding all their channels
+        owners = set(self.owner(channel) for channel in bindings.itervalues())
+        if len(owners) != 1:
+            raise ValueError('Channels for rules {0} are on several brokers'.format(rules_id))
+        return self.brokers[owners.pop()].pn_attach_rules(rules_id, rules, bindings, *args)
+
+    def pn_detach_rules(self, rules_id):
+        for proxy in self.brokers.itervalues():
+            proxy.pn_detach_rules(rules_id)
+
+    def pn_get_many(self, channels, with_times=False):
+        values = [None] * len(channels)
+        for name, requests in self._split(channels).iteritems():
+            got = self.brokers[name].pn_get_many([channel for i, channel in requests], with_times)
+            for (i, channel), value in zip(requests, got):
+                values[i] = value
+        return values
+
+    def pn_put_many(self, items):
+        shards = {}
+        for value, channel in items:
+            shards.setdefault(self.owner(channel), []).append((value, channel))
+        for name, shard_items in shards.iteritems():
+            self.brokers[name].pn_put_many(shard_items)
+
+    def pn_channels(self):
+        channels = []
+        for proxy in self.brokers.itervalues():
+            channels.extend(proxy.pn_channels())
+        return channels
+
+    def pn_subscribe(self, subscriber, pattern, sub_id=None, max_rate=None, latest_only=False, max_pending=10000):
+        if sub_id is None:
+            sub_id = '%s/%d' % (subscriber, next(self._sub_ids))
+        args = (subscriber, pattern, sub_id, max_rate, latest_only, max_pending)
+        self.subscriptions[sub_id] = args
+        for proxy in self.brokers.itervalues():
+            proxy.pn_subscribe(*args)
+        return sub_id
+
+    def pn_unsubscribe(self, sub_id):
+        self.subscriptions.pop(sub_id, None)
+        for proxy in self.brokers.itervalues():
+            proxy.pn_unsubscribe(sub_id)
+
+
 class PyroNode(object):
 
-    # Shared deamon object
-    host = get_public_ip_addr()
-    daemon = Pyro4.Daemon(host=host)
+    # Shared deamon object, and the address it binds to, made on first use unless set
+    # first with configure()
+    daemon_kwargs = {}
+
+    @lazy_class_attribute
+    def host(cls):
+        try:
+            return get_public_ip_addr()
+        except socket.error:
+            # No route out, ie, an air-gapped host
+            try:
+                return socket.gethostbyname(get_host_name())
+            except socket.error:
+                return '127.0.0.1'
+
+    @lazy_class_attribute
+    def daemon(cls):
+        return Pyro4.Daemon(host=cls.host, **cls.daemon_kwargs)
+
+    @classmethod
+    def configure(cls, host=None, daemon=None, **daemon_kwargs):
+        # Bind address, a daemon to use, or other Pyro4.Daemon args, before the first
+        # node is made
+        if host is not None:
+            cls.host = host
+        if daemon is not None:
+            cls.daemon = daemon
+        cls.daemon_kwargs.update(daemon_kwargs)
+    # Shared proxies to other nodes by name
+    proxies = ProxyPool()
 
     @classmethod
     def get_proxy(cls, node):
-        if isinstance(node, PyroNode):
+        if isinstance(node, (PyroNode, PooledProxy, LocalProxy, ShardedBroker)):
             return node
         elif isinstance(node, basestring):
-            return Pyro4.Proxy("PYRONAME:" + node)
+            return cls.proxies.get(node)
+        elif isinstance(node, (list, tuple)):
+            return ShardedBroker(node)
         else:
             return None
 
@@ -53,18 +1117,67 @@ class PyroNode(object):
         self.pn_id = kwargs.get('pn_id')
         # self._pn_status = 'init'
         self.logger = logging.getLogger(self.pn_id)
-        self.logger.debug('Setting up {0}@{1}'.format(self.pn_id, PyroNode.host))
-        uri = PyroNode.daemon.register(self)
-        ns = Pyro4.locateNS()
-        ns.register(self.pn_id, uri)
+        # register=False makes a node only reachable from this process, and then
+        # nothing needs the host address
+        if kwargs.get('register', True):
+            self.logger.debug('Setting up {0}@{1}'.format(self.pn_id, PyroNode.host))
+            uri = PyroNode.daemon.register(self)
+            ns = Pyro4.locateNS()
+            ns.register(self.pn_id, uri)
+        # Other nodes in this process can skip the network
+        PyroNode.proxies.add_local(self.pn_id, self)
         self._broker = None
         self.broker = kwargs.get('broker')
         self.update_funcs = []
         self.update_freq = kwargs.get('update_freq', 1000.)
-        # Dictionary for storing data streams
+        # Scheduled tasks, one per update rate, see run()
+        self.tasks = []
+        # Send batched puts without waiting for the broker to reply
+        self.oneway_puts = kwargs.get('oneway_puts', False)
+        # id(broker) -> (broker, its oneway handle), for oneway_puts
+        self._oneway_brokers = {}
+        # Dictionary for storing data streams, channel -> ChannelBuffer
         self.pn_data = {}
-        # Do not need a lock on pn_data access b/c only the owner writes to it
+        self.channel_capacity = kwargs.get('channel_capacity', 1024)
+        # Do not need a lock on pn_data access b/c only the owner writes to it, and
+        # each channel has a single source.  Rule stages span channels, so they lock
+        # for themselves.
         # self.lock = threading.Lock()
+        # Push subscriptions held as a broker, sub_id -> Subscription, and the
+        # subscriptions matching each channel
+        self.pn_subscriptions = {}
+        self._channel_subscriptions = {}
+        self._dispatch = None
+        self.dispatch_threads = kwargs.get('dispatch_threads', 4)
+        # Handlers for subscriptions held as a sink, sub_id -> (update_func, args, batch)
+        self.pn_handlers = {}
+        self._sub_ids = itertools.count()
+        # Rules evaluated on puts as a broker, rules_id -> RuleStage, and the stages
+        # bound to each channel
+        self.pn_rules = {}
+        self._channel_rules = {}
+        # Alerts channel -> lock, for rule stages that share one
+        self._alert_locks = {}
+        # Put-to-callback latency of pushed values, seconds
+        self.push_latency = deque(maxlen=1000)
+        # Host-local mode.  As a broker, mirror channels into SharedChannels, channel ->
+        # SharedChannel.  As a sink, read channels from them when the broker is on this
+        # host.  Values that aren't fixed size numbers still go over Pyro.
+        self.shared_memory = kwargs.get('shared_memory', False)
+        self.pn_shared = {}
+        self._shared_names = itertools.count()
+        if self.shared_memory:
+            atexit.register(self.close_shared)
+        # Instrumentation, see pn_stats.  channel -> RateCounter for values sent as a
+        # source, received as a sink and served as a broker, channel -> LatencyHistogram
+        # of the age of values when received, and name -> LatencyHistogram of calls to
+        # brokers and of other update types.
+        self.started = time.time()
+        self.stats_sent = {}
+        self.stats_received = {}
+        self.stats_served = {}
+        self.stats_age = {}
+        self.stats_calls = {}
 
     @property
     def update_interval(self):
@@ -83,14 +1196,304 @@ class PyroNode(object):
         self._broker = PyroNode.get_proxy(_broker)
 
     def pn_get(self, channel):
-        return self.pn_data.get(channel)
+        buffer = self.pn_data.get(channel)
+        if buffer is not None:
+            self._count(self.stats_served, channel, time.time())
+            return buffer.latest
 
     def pn_put(self, value, channel):
-        self.pn_data[channel] = value
+        buffer = self.pn_data.get(channel)
+        if buffer is None:
+            buffer = self.pn_data.setdefault(channel, ChannelBuffer(self.channel_capacity))
+        buffer.put(value)
+        if self.shared_memory:
+            self._share(channel, buffer)
+        if self.pn_subscriptions:
+            self._publish(channel, buffer.seq - 1, buffer.latest_time, value)
+        stages = self._channel_rules.get(channel)
+        if stages:
+            for stage in stages:
+                stage.on_put(channel, value, buffer.latest_time)
+
+    def pn_attach_rules(self, rules_id, rules, bindings, alerts_channel=None, mode='transitions',
+                        names=None, record_history=False):
+        # Evaluate rules here on every put to the channels in bindings, variable ->
+        # channel, see RuleStage.  Alerts go to alerts_channel, by default
+        # (rules_id, 'alerts'), and the channel is returned.  Replaces any rules
+        # already attached as rules_id.
+        self.pn_detach_rules(rules_id)
+        if alerts_channel is None:
+            alerts_channel = (rules_id, 'alerts')
+        stage = RuleStage(self, rules_id, rules, bindings, alerts_channel, mode, names, record_history)
+        self.pn_rules[rules_id] = stage
+        for channel in stage.bindings:
+            self._channel_rules.setdefault(channel, []).append(stage)
+        # Start from what's already buffered
+        for channel in stage.bindings:
+            buffer = self.pn_data.get(channel)
+            if buffer is not None and buffer.seq:
+                stage.on_put(channel, buffer.latest, buffer.latest_time)
+        return list(stage.alerts_channel)
+
+    def pn_detach_rules(self, rules_id):
+        stage = self.pn_rules.pop(rules_id, None)
+        if stage is not None:
+            for channel in stage.bindings:
+                self._channel_rules[channel].remove(stage)
+                if not self._channel_rules[channel]:
+                    del self._channel_rules[channel]
+
+    def pn_rules_stats(self):
+        return dict((rules_id, stage.stats()) for rules_id, stage in self.pn_rules.items())
+
+    def _publish(self, channel, seq, timestamp, value):
+        subscriptions = self._channel_subscriptions.get(channel)
+        if subscriptions is None:
+            subscriptions = [sub for sub in self.pn_subscriptions.values() if sub.matches(channel)]
+            self._channel_subscriptions[channel] = subscriptions
+        for subscription in subscriptions:
+            with subscription.lock:
+                if len(subscription.pending) == subscription.pending.maxlen:
+                    if not subscription.dropped:
+                        self.logger.warning('Subscription %s is full, dropping its oldest values' % subscription.sub_id)
+                    subscription.dropped += 1
+                subscription.pending.append((channel, seq, timestamp, value))
+                self._dispatch.schedule(subscription)
+
+    def pn_subscribe(self, subscriber, pattern, sub_id=None, max_rate=None, latest_only=False, max_pending=10000):
+        # Push every value put to channels matching pattern to subscriber's pn_notify
+        if self._dispatch is None:
+            self._dispatch = DispatchPool(self.dispatch_threads)
+        if sub_id is None:
+            sub_id = '%s/%d' % (subscriber, next(self._sub_ids))
+        self.pn_subscriptions[sub_id] = Subscription(sub_id, subscriber, pattern, max_rate, latest_only,
+                                                      max_pending)
+        self._channel_subscriptions = {}
+        return sub_id
+
+    def pn_unsubscribe(self, sub_id):
+        self.pn_subscriptions.pop(sub_id, None)
+        self._channel_subscriptions = {}
+
+    def pn_notify(self, sub_id, items):
+        # Called by the broker with a list of (channel, seq, time, value)
+        handler = self.pn_handlers.get(sub_id)
+        if handler is None:
+            return
+        update_func, args, batch = handler
+        now = time.time()
+        for item in items:
+            self.push_latency.append(now - item[2])
+            self._count(self.stats_received, tuple(item[0]), now, age=now - item[2])
+        if batch:
+            update_func(items, *args)
+        else:
+            for channel, seq, timestamp, value in items:
+                update_func(value, *args)
+
+    def subscribe(self, pattern, update_func, *args, **kwargs):
+        # Sink side of pn_subscribe.  update_func is called with each value, or with
+        # the list of (channel, seq, time, value) if batch=True.  Takes max_rate,
+        # latest_only and max_pending like pn_subscribe, and a broker other than our own.
+        broker = PyroNode.get_proxy(kwargs.get('broker')) or self.broker
+        sub_id = '%s/%d' % (self.pn_id, next(self._sub_ids))
+        self.pn_handlers[sub_id] = (update_func, args, kwargs.get('batch', False))
+        broker.pn_subscribe(self.pn_id, pattern, sub_id, kwargs.get('max_rate'), kwargs.get('latest_only', False),
+                            kwargs.get('max_pending', 10000))
+        return sub_id
+
+    def unsubscribe(self, sub_id, broker=None):
+        broker = PyroNode.get_proxy(broker) or self.broker
+        broker.pn_unsubscribe(sub_id)
+        self.pn_handlers.pop(sub_id, None)
+
+    def watch_rules(self, rules_id, rules, bindings, update_func, *args, **kwargs):
+        # Attach rules to the broker and subscribe update_func to their alerts.  Takes
+        # alerts_channel, mode, names and record_history as pn_attach_rules, and the
+        # rest as subscribe.  Returns the sub_id.
+        broker = PyroNode.get_proxy(kwargs.get('broker')) or self.broker
+        alerts_channel = broker.pn_attach_rules(rules_id, rules, bindings, kwargs.pop('alerts_channel', None),
+                                                kwargs.pop('mode', 'transitions'), kwargs.pop('names', None),
+                                                kwargs.pop('record_history', False))
+        return self.subscribe(tuple(alerts_channel), update_func, *args, **kwargs)
+
+    def _count(self, counters, channel, now, n=1, age=None):
+        counter = counters.get(channel)
+        if counter is None:
+            counter = counters.setdefault(channel, RateCounter())
+        counter.add(now, n)
+        if age is not None:
+            ages = self.stats_age.get(channel)
+            if ages is None:
+                ages = self.stats_age.setdefault(channel, LatencyHistogram())
+            ages.record(max(age, 0.))
+
+    def _time_call(self, name, duration):
+        histogram = self.stats_calls.get(name)
+        if histogram is None:
+            histogram = self.stats_calls.setdefault(name, LatencyHistogram())
+        histogram.record(duration)
+
+    @staticmethod
+    def channel_name(channel):
+        # Channel keys as strings, for json
+        if isinstance(channel, (list, tuple)):
+            return '/'.join(str(part) for part in channel)
+        return str(channel)
+
+    def pn_stats(self):
+        # Snapshot of this node's instrumentation, only plain types so any serializer
+        # can carry it
+        now = time.time()
+        channels = {}
+
+        def entry(channel):
+            return channels.setdefault(PyroNode.channel_name(channel), {})
+
+        for channel, buffer in self.pn_data.items():
+            entry(channel).update({'puts': buffer.seq, 'put_rate': buffer.rate(),
+                                   'age': now - buffer.latest_time if buffer.latest_time else None})
+        for key, counters in [('served', self.stats_served), ('sent', self.stats_sent),
+                              ('received', self.stats_received)]:
+            for channel, counter in counters.items():
+                entry(channel).update({key: counter.count, key + '_rate': counter.rate()})
+        for channel, ages in self.stats_age.items():
+            entry(channel)['received_age'] = ages.summary()
+        for channel, counter in self.stats_received.items():
+            entry(channel)['stale'] = now - counter.last
+
+        return {'pn_id': self.pn_id,
+                'host': PyroNode.host,
+                'time': now,
+                'uptime': now - self.started,
+                'channels': channels,
+                'calls': dict((name, histogram.summary()) for name, histogram in self.stats_calls.items()),
+                'tasks': [task.stats() for task in self.tasks],
+                'push_latency': self.push_latency_stats(),
+                'rules': self.pn_rules_stats(),
+                'subscriptions': dict((sub_id, {'delivered': sub.delivered, 'dropped': sub.dropped,
+                                                'failures': sub.failures, 'pending': len(sub.pending)})
+                                      for sub_id, sub in self.pn_subscriptions.items())}
+
+    def export_stats(self, path):
+        # Append a pn_stats snapshot to a json lines file
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.pn_stats(), sort_keys=True) + '\n')
+
+    @staticmethod
+    def collect_stats(nodes):
+        # pn_stats from each of a list of nodes, or the error trying
+        stats = {}
+        for node in nodes:
+            try:
+                stats[node] = PyroNode.get_proxy(node).pn_stats()
+            except Exception as e:
+                stats[node] = {'error': repr(e)}
+        return stats
+
+    def push_latency_stats(self):
+        # Summary of recent push latencies in seconds
+        latencies = np.array(self.push_latency)
+        if not len(latencies):
+            return {'count': 0}
+        return {'count': len(latencies),
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max())}
+
+    def pn_get_since(self, channel, seq=None, timestamp=None):
+        # Everything still buffered for a channel since a seq or a time, as one
+        # structured array with seq, time and value fields
+        buffer = self.pn_data.get(tuple(channel))
+        if buffer is None:
+            return ChannelBuffer(0).get_since()
+        self._count(self.stats_served, tuple(channel), time.time())
+        return buffer.get_since(seq, timestamp)
+
+    def pn_channels(self):
+        return self.pn_data.keys()
+
+    def pn_load(self, channel, history):
+        # Take over a channel's history from another broker, as from pn_get_since,
+        # merged by time with anything already put here
+        channel = tuple(channel)
+        rows = list(history)
+        buffer = self.pn_data.get(channel)
+        if buffer is not None:
+            rows.extend(buffer.get_since())
+        rows.sort(key=lambda row: row['time'])
+        self._unshare(channel)
+        loaded = ChannelBuffer(self.channel_capacity)
+        if len(history):
+            loaded.seq = int(history['seq'][0])
+        for row in rows:
+            loaded.put(row['value'], float(row['time']))
+        self.pn_data[channel] = loaded
+        self._channel_subscriptions.pop(channel, None)
+
+    def pn_drop(self, channel):
+        # Forget a channel, returns its history as pn_get_since did
+        buffer = self.pn_data.pop(tuple(channel), None)
+        self._channel_subscriptions.pop(tuple(channel), None)
+        self._unshare(tuple(channel))
+        if buffer is None:
+            return ChannelBuffer(0).get_since()
+        return buffer.get_since()
+
+    def _share(self, channel, buffer):
+        shared = self.pn_shared.get(channel)
+        values = buffer.values
+        if values.dtype == object:
+            self._unshare(channel)
+            return
+        if shared is None or not shared.fits(values.dtype, values.shape[1:]):
+            # New, or widened since
+            self._unshare(channel)
+            name = 'pyronode-{0}-{1}-{2}'.format(os.getpid(), self.pn_id, next(self._shared_names))
+            shared = SharedChannel.create(name, buffer.capacity, values.dtype, values.shape[1:], buffer.seq - 1)
+            self.pn_shared[channel] = shared
+        shared.put(buffer.latest, buffer.latest_time)
+
+    def _unshare(self, channel):
+        shared = self.pn_shared.pop(channel, None)
+        if shared is not None:
+            shared.close()
+
+    def close_shared(self):
+        for channel in self.pn_shared.keys():
+            self._unshare(channel)
+
+    def pn_shared_channel(self, channel):
+        # Where a sink on this host can map the channel, or None
+        shared = self.pn_shared.get(tuple(channel))
+        if shared is not None:
+            return {'host': get_host_name(), 'path': shared.path}
+
+    # Batched versions, one remote call per tick instead of one per channel.  Channels
+    # may arrive as lists after a round trip through the serializer.
+
+    def pn_get_many(self, channels, with_times=False):
+        # with_times gives (time, value) for each channel
+        values = [self.pn_get(tuple(channel)) for channel in channels]
+        if with_times:
+            times = [getattr(self.pn_data.get(tuple(channel)), 'latest_time', None) for channel in channels]
+            return zip(times, values)
+        return values
+
+    def pn_put_many(self, items):
+        # items is a list of (value, channel), same order as pn_put
+        for value, channel in items:
+            self.pn_put(value, tuple(channel))
 
     def add_update_func(self, type, update_func, *args, **kwargs):
+        # Pass update_freq to run this func at its own rate instead of the node's.
+        # Update types get kwargs as a copy each tick, so anything they need to keep
+        # between ticks goes in the state dict.
         kwargs.update({
-            'broker': self.broker
+            'broker': self.broker,
+            'state': {},
+            'shared_memory': self.shared_memory
             })
         self.update_funcs.append(
             [type, update_func, args, kwargs]
@@ -102,35 +1505,160 @@ class PyroNode(object):
         broker = kwargs.get('broker')
         value = update_func(*args)
         #logging.debug('PUT {0}:{1}'.format(channel, value))
-        if value:
+        if value is not None:
             broker.pn_put(value, channel)
 
+    @staticmethod
+    def shared_reader(**kwargs):
+        # SharedChannel for a get update's channel, if it has shared_memory and the
+        # broker mirrors the channel on this host.  Brokers that don't yet are asked
+        # again at most once a second.
+        if not kwargs.get('shared_memory'):
+            return None
+        state = kwargs['state']
+        reader = state.get('reader')
+        if reader is not None and not reader.closed:
+            return reader
+        state['reader'] = None
+        if state.get('retry', 0) > monotonic():
+            return None
+        try:
+            info = kwargs['broker'].pn_shared_channel(kwargs.get('channel'))
+        except AttributeError:
+            # Broker from before shared channels
+            info = None
+        if info and info['host'] == get_host_name() and os.path.exists(info['path']):
+            try:
+                state['reader'] = SharedChannel(info['path'])
+            except (IOError, ValueError):
+                pass
+        if state['reader'] is None:
+            state['retry'] = monotonic() + 1.
+        return state['reader']
+
     @classmethod
     def get_from_channel(cls, update_func, *args, **kwargs):
         channel = kwargs.get('channel')
         broker = kwargs.get('broker')
-        value = broker.pn_get(channel)
-        #logging.debug('GET {0}:{1}'.format(channel, value))
-        if value and update_func:
-            update_func(value, *args)
+        state = kwargs.get('state', {})
+        reader = PyroNode.shared_reader(**kwargs)
+        if reader:
+            timestamp, value = reader.latest(with_time=True)
+        else:
+            (timestamp, value), = broker.pn_get_many([channel], True)
+        if value is not None:
+            # For the instrumentation in update_all
+            state['received'], state['time'] = 1, timestamp
+            if update_func:
+                update_func(value, *args)
+
+    @staticmethod
+    def set_oneway(proxy, *methods):
+        # Mark methods oneway on a Pyro proxy.  Binding fetches the remote metadata,
+        # which would otherwise overwrite the oneway set on first connect.
+        if isinstance(proxy, (PooledProxy, LocalProxy, ShardedBroker)):
+            proxy.set_oneway(*methods)
+        elif isinstance(proxy, Pyro4.Proxy):
+            proxy._pyroBind()
+            proxy._pyroOneway.update(methods)
+
+    @staticmethod
+    def oneway_proxy(proxy, *methods):
+        # Proxy making methods oneway for the caller only.  set_oneway changes the
+        # proxy itself, and pooled handles are shared by every node in the process.
+        if isinstance(proxy, (PooledProxy, LocalProxy)):
+            return proxy.with_oneway(*methods)
+        PyroNode.set_oneway(proxy, *methods)
+        return proxy
+
+    @classmethod
+    def get_since_from_channel(cls, update_func, *args, **kwargs):
+        # Lossless alternative to get_from_channel, passes update_func every value put
+        # since the last call as one structured array.  The cursor is kept in state.
+        channel = kwargs.get('channel')
+        broker = kwargs.get('broker')
+        state = kwargs.get('state', {})
+        reader = PyroNode.shared_reader(**kwargs)
+        values = reader.get_since(state.get('seq')) if reader else broker.pn_get_since(channel, state.get('seq'))
+        if len(values):
+            state['seq'] = int(values['seq'][-1]) + 1
+            state['received'], state['time'] = len(values), float(values['time'][-1])
+            if update_func:
+                update_func(values, *args)
 
     def update(self, update_func=None, **kwargs):
         raise NotImplementedError
 
-    def run(self):
-        def update_loop():
-            interval = 1/self.update_freq
-            while 1:
-                time_begin = time.time()
-                for update in self.update_funcs:
-                    update[0](update[1], *update[2], **update[3])
-                time_end = time.time()
-                time_elapsed = time_end - time_begin
-                if interval - time_elapsed > 0:
-                    time.sleep(interval - time_elapsed)
-        thread = threading.Thread(target=update_loop)
-        thread.setDaemon(True)
-        thread.start()
+    def update_all(self, update_funcs=None):
+        # Run one tick.  put_in_channel and get_from_channel updates bound for the
+        # same broker are coalesced into one pn_put_many and one pn_get_many call,
+        # any other update type is called as is.
+        puts = {}
+        gets = {}
+        for update_type, update_func, args, kwargs in (update_funcs or self.update_funcs):
+            func = getattr(update_type, '__func__', update_type)
+            broker = kwargs.get('broker')
+            if func is PyroNode.put_in_channel.__func__:
+                value = update_func(*args)
+                if value is not None:
+                    puts.setdefault(id(broker), (broker, []))[1].append((value, kwargs.get('channel')))
+            elif func is PyroNode.get_from_channel.__func__ and not PyroNode.shared_reader(**kwargs):
+                gets.setdefault(id(broker), (broker, []))[1].append((kwargs.get('channel'), update_func, args))
+            else:
+                begin = time.time()
+                update_type(update_func, *args, **kwargs)
+                end = time.time()
+                self._time_call(getattr(func, '__name__', 'update'), end - begin)
+                # Update types may leave how many values they got, and the time of the
+                # latest, in state
+                state = kwargs.get('state', {})
+                if 'received' in state:
+                    channel = kwargs.get('channel')
+                    self._count(self.stats_received, tuple(channel) if channel else None, end,
+                                state.pop('received'), end - (state.pop('time') or end))
+
+        for broker, items in puts.itervalues():
+            if self.oneway_puts:
+                entry = self._oneway_brokers.get(id(broker))
+                if entry is None or entry[0] is not broker:
+                    entry = self._oneway_brokers[id(broker)] = (broker, PyroNode.oneway_proxy(broker, 'pn_put_many'))
+                broker = entry[1]
+            begin = time.time()
+            broker.pn_put_many(items)
+            end = time.time()
+            self._time_call('pn_put_many', end - begin)
+            for value, channel in items:
+                self._count(self.stats_sent, channel, end)
+
+        for broker, requests in gets.itervalues():
+            begin = time.time()
+            values = broker.pn_get_many([channel for channel, update_func, args in requests], True)
+            end = time.time()
+            self._time_call('pn_get_many', end - begin)
+            for (channel, update_func, args), (timestamp, value) in zip(requests, values):
+                if value is not None:
+                    self._count(self.stats_received, channel, end, age=end - timestamp)
+                    if update_func:
+                        update_func(value, *args)
+
+    def run(self, scheduler=None):
+        # Hand the update funcs to a scheduler, the shared one by default, as one
+        # task per update rate so updates at the same rate still batch together
+        scheduler = scheduler or PyroScheduler.shared()
+        groups = {}
+        for update in self.update_funcs:
+            freq = float(update[3].get('update_freq') or self.update_freq)
+            groups.setdefault(freq, []).append(update)
+        for freq, updates in groups.iteritems():
+            task = scheduler.add(lambda updates=updates: self.update_all(updates), 1. / freq,
+                                 name='{0}@{1:g}Hz'.format(self.pn_id, freq))
+            self.tasks.append(task)
+        scheduler.start()
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
 
 
 def test_pyronode():
@@ -156,6 +1684,453 @@ def test_pyronode():
     PyroNode.daemon.requestLoop()
 
 
+def test_channel_buffer():
+
+    buffer = ChannelBuffer(4)
+    for i in range(6):
+        buffer.put(i, timestamp=100. + i)
+    assert(buffer.latest == 5 and len(buffer) == 4)
+
+    values = buffer.get_since()
+    assert(list(values['seq']) == [2, 3, 4, 5] and list(values['value']) == [2, 3, 4, 5])
+    assert(list(buffer.get_since(seq=4)['value']) == [4, 5])
+    assert(list(buffer.get_since(timestamp=103.)['seq']) == [4, 5])
+    assert(len(buffer.get_since(seq=6)) == 0)
+
+    # Widens for floats, falls back on objects for ragged values
+    buffer.put(6.5)
+    assert(buffer.get_since(seq=6)['value'][0] == 6.5)
+    buffer.put([1, 2, 3])
+    assert(list(buffer.get_since(seq=7)['value'][0]) == [1, 2, 3])
+    objects = ChannelBuffer(4)
+    objects.put({'rule': 1})
+    assert(objects.get_since()['value'][0] == {'rule': 1})
+
+    waveform = ChannelBuffer(8)
+    for i in range(3):
+        waveform.put(np.arange(4) + i)
+    assert(waveform.get_since()['value'].shape == (3, 4))
+
+
+def test_ndarray_codec():
+
+    waveform = np.random.rand(2, 500).astype(np.float32)
+    history = ChannelBuffer(4)
+    history.put(np.arange(3))
+    records = history.get_since()
+    ragged = np.array([[1], 'a'], dtype=object)
+
+    for name in ['serpent', 'marshal', 'json']:
+        serializer = Pyro4.util.get_serializer(name)
+        for array in [waveform, waveform[:, ::2], records, np.array(1.5), np.zeros(0)]:
+            data, compressed = serializer.serializeData(array)
+            decoded = serializer.deserializeData(data, compressed)
+            assert(decoded.dtype == array.dtype and decoded.shape == array.shape)
+            assert(np.array_equal(decoded, array))
+        decoded = serializer.deserializeData(serializer.serializeData(ragged)[0])
+        assert(list(decoded) == [[1], 'a'])
+
+
+def test_proxy_pool():
+
+    class FakeNameServer(object):
+        def lookup(self, name):
+            return 'PYRO:{0}@localhost:1'.format(name)
+
+    pool = ProxyPool(ttl=0.05)
+    pool.local.ns = FakeNameServer()
+    assert(pool.get('a') is pool.get('a'))
+    assert(pool.lookup('a') == pool.lookup('a') and pool.lookups == 1)
+    time.sleep(0.06)
+    pool.lookup('a')
+    assert(pool.lookups == 2)
+    pool.invalidate('a')
+    pool.lookup('a')
+    assert(pool.lookups == 3)
+
+    proxies = []
+    thread = threading.Thread(target=lambda: proxies.append(pool.local_proxies()))
+    thread.start()
+    thread.join()
+    assert(proxies[0] is not pool.local_proxies())
+
+    handle = pool.get('b')
+    PyroNode.set_oneway(handle, 'pn_put_many')
+    assert(handle._oneway == set(['pn_put_many']))
+
+    # Calls that may have run aren't repeated, read-only ones are tried again
+    class DroppedProxy(object):
+        calls = []
+        def _pyroRelease(self):
+            pass
+        def __getattr__(self, method):
+            def call(*args):
+                DroppedProxy.calls.append(method)
+                raise Pyro4.errors.ConnectionClosedError('dropped')
+            return call
+
+    handle = pool.get('c')
+    lookups = pool.lookups
+    for method in ['pn_put', 'pn_get']:
+        pool.local_proxies()['c'] = [DroppedProxy()]
+        try:
+            getattr(handle, method)(1, 'x')
+            assert(False)
+        except Pyro4.errors.CommunicationError:
+            pass
+    # Only pn_get looked the node up again to retry
+    assert(DroppedProxy.calls == ['pn_put', 'pn_get'] and pool.lookups == lookups + 1)
+
+
+def test_local_proxy():
+
+    class Node(object):
+        def __init__(self):
+            self.values = []
+        def pn_put(self, value, channel):
+            if value is None:
+                raise ValueError
+            self.values.append(value)
+            return len(self.values)
+        def _private(self):
+            pass
+
+    pool = ProxyPool()
+    remote = pool.get('n')
+    node = Node()
+    pool.add_local('n', node)
+    proxy = pool.get('n')
+    assert(isinstance(remote, PooledProxy) and isinstance(proxy, LocalProxy))
+    assert(proxy is pool.get('n'))
+
+    assert(proxy.pn_put(1, 'c') == 1)
+    PyroNode.set_oneway(proxy, 'pn_put')
+    assert(proxy.pn_put(2, 'c') is None and node.values == [1, 2])
+    proxy.pn_put(None, 'c')
+    try:
+        proxy._private()
+        assert(False)
+    except AttributeError:
+        pass
+
+    pool = ProxyPool(local_calls=False)
+    pool.add_local('n', node)
+    assert(isinstance(pool.get('n'), PooledProxy))
+
+
+def test_batched_updates():
+
+    calls = []
+    failing = []
+
+    class Broker(PyroNode):
+        def pn_put_many(self, items):
+            if failing:
+                raise RuntimeError('Broker failed')
+            calls.append(('put', len(items)))
+            PyroNode.pn_put_many(self, items)
+
+        def pn_get_many(self, channels, with_times=False):
+            calls.append(('get', len(channels)))
+            return PyroNode.pn_get_many(self, channels, with_times)
+
+    broker = Broker(pn_id='batch_broker', register=False)
+    node = PyroNode(pn_id='batch_node', broker='batch_broker', register=False)
+    got = []
+    for i in range(3):
+        node.add_update_func(PyroNode.put_in_channel, lambda i=i: float(i), channel=('batch', 'put%d' % i))
+    node.add_update_func(PyroNode.put_in_channel, lambda: None, channel=('batch', 'none'))
+    for i in range(2):
+        node.add_update_func(PyroNode.get_from_channel, got.append, channel=('batch', 'put%d' % i))
+    node.add_update_func(PyroNode.get_from_channel, got.append, channel=('batch', 'none'))
+
+    # One call each way per tick, the puts before the gets
+    node.update_all()
+    assert(calls == [('put', 3), ('get', 3)] and got == [0., 1.])
+    node.update_all()
+    assert(calls[2:] == [('put', 3), ('get', 3)] and got == [0., 1., 0., 1.])
+    assert(broker.pn_stats()['channels']['batch/put2']['puts'] == 2)
+
+    # Oneway puts return nothing
+    node = PyroNode(pn_id='batch_oneway', broker='batch_broker', register=False, oneway_puts=True)
+    node.add_update_func(PyroNode.put_in_channel, lambda: 1., channel=('batch', 'oneway'))
+    node.add_update_func(PyroNode.get_from_channel, got.append, channel=('batch', 'oneway'))
+    node.update_all()
+    assert(got[-1] == 1.)
+    handle = node._oneway_brokers[id(node.broker)][1]
+    assert(handle.pn_put_many([]) is None and handle._node is broker)
+
+    # Only for this node, others using the same broker handle still see errors
+    assert(not node.broker._oneway and node.broker is PyroNode.get_proxy('batch_broker'))
+    failing.append(True)
+    node.update_all()
+    try:
+        PyroNode.get_proxy('batch_broker').pn_put_many([])
+        assert(False)
+    except RuntimeError:
+        pass
+
+
+def test_subscriptions():
+
+    def wait_for(done):
+        for i in range(200):
+            if done():
+                return True
+            time.sleep(0.01)
+
+    subscription = Subscription('s', 'sink', ('bed*', 'hr'))
+    assert(subscription.matches(('bed1', 'hr')) and subscription.matches([u'bed12', u'hr']))
+    assert(not subscription.matches(('bed1', 'spo2')) and not subscription.matches(('bed1', 'hr', 'x')))
+
+    broker = PyroNode(pn_id='sub_broker', register=False)
+    sink = PyroNode(pn_id='sub_sink', broker='sub_broker', register=False)
+
+    # Values of matching channels only, in put order
+    values, batches = [], []
+    sink.subscribe(('bed*', 'hr'), values.append)
+    sink.subscribe(('bed1', '*'), batches.append, batch=True)
+    for i in range(20):
+        broker.pn_put(i, ('bed1', 'hr'))
+        broker.pn_put(-i, ('bed2', 'spo2'))
+    assert(wait_for(lambda: len(values) == 20 and sum(map(len, batches)) == 20))
+    assert(values == range(20))
+    assert([item[3] for batch in batches for item in batch] == range(20))
+    assert(all(tuple(item[0]) == ('bed1', 'hr') for batch in batches for item in batch))
+
+    # max_rate holds values back on a timer and ships them together
+    limited = []
+    sink.subscribe(('bed3', '*'), limited.append, batch=True, max_rate=10)
+    broker.pn_put(0, ('bed3', 'hr'))
+    assert(wait_for(lambda: limited))
+    for i in range(1, 10):
+        broker.pn_put(i, ('bed3', 'hr'))
+    assert(wait_for(lambda: sum(map(len, limited)) == 10))
+    assert(len(limited) == 2 and [item[3] for item in limited[1]] == range(1, 10))
+
+    # latest_only keeps the newest value per channel between deliveries
+    subscription = Subscription('s', 'sink', ('bed4', '*'), latest_only=True)
+    for i in range(5):
+        for name in ['hr', 'spo2']:
+            subscription.pending.append((('bed4', name), i, 100. + i, name + str(i)))
+    items, wait = subscription.take()
+    assert([item[3] for item in items] == ['hr4', 'spo24'] and not subscription.pending)
+
+    # A full queue drops its oldest values and counts them
+    dropped = []
+    sub_id = sink.subscribe(('bed5', 'hr'), dropped.extend, batch=True, max_rate=5, max_pending=3)
+    broker.pn_put(0, ('bed5', 'hr'))
+    assert(wait_for(lambda: dropped))
+    for i in range(1, 10):
+        broker.pn_put(i, ('bed5', 'hr'))
+    assert(wait_for(lambda: len(dropped) == 4))
+    assert([item[3] for item in dropped] == [0, 7, 8, 9])
+    assert(broker.pn_stats()['subscriptions'][sub_id]['dropped'] == 6)
+
+
+def test_sharded_broker():
+
+    brokers = [PyroNode(pn_id='shard%d' % i, register=False) for i in range(3)]
+    sharded = PyroNode.get_proxy(['shard0', 'shard1'])
+    channels = [('src', 'ch%d' % i) for i in range(40)]
+    for i in range(3):
+        sharded.pn_put_many([(i, channel) for channel in channels])
+
+    # Both shards used, and each channel only on its owner
+    owners = [sharded.owner(channel) for channel in channels]
+    assert(set(owners) == set(['shard0', 'shard1']))
+    assert(len(brokers[0].pn_data) + len(brokers[1].pn_data) == 40)
+    assert(sharded.pn_get_many(channels) == [2] * 40)
+    assert(sharded.owner([u'src', u'ch0']) == owners[0])
+
+    # Adding a shard only moves channels onto it
+    sharded.add_broker('shard2')
+    new_owners = [sharded.owner(channel) for channel in channels]
+    assert(all(new == old or new == 'shard2' for old, new in zip(owners, new_owners)))
+    assert(0 < sharded.moved == len(brokers[2].pn_data) < 40)
+    assert(sorted(sharded.pn_channels()) == sorted(channels))
+    moved = [channel for channel in channels if sharded.owner(channel) == 'shard2']
+    assert(list(sharded.pn_get_since(moved[0])['value']) == [0, 1, 2])
+    assert(sharded.rebalance() == 0)
+
+    # Puts from a node with the old ring are moved by the next rebalance
+    old_owner = owners[channels.index(moved[0])]
+    brokers[int(old_owner[-1])].pn_put(3, moved[0])
+    assert(sharded.rebalance() == 1)
+    assert(list(sharded.pn_get_since(moved[0])['value']) == [0, 1, 2, 3])
+
+    # Default sub_ids aren't reused after an unsubscribe
+    a = sharded.pn_subscribe('sink', ('src', '*'))
+    b = sharded.pn_subscribe('sink', ('src', '*'))
+    sharded.pn_unsubscribe(a)
+    c = sharded.pn_subscribe('sink', ('src', '*'))
+    assert(c != b and set(brokers[2].pn_subscriptions) == set([b, c]))
+
+    # Shards are named the same however they are given
+    assert(ShardedBroker.broker_name(PyroNode.get_proxy('shard0')) == 'shard0')
+    assert(ShardedBroker.broker_name(brokers[1]) == 'shard1')
+    try:
+        ShardedBroker([object()])
+        assert(False)
+    except ValueError:
+        pass
+
+
+def test_shared_channel():
+
+    broker = PyroNode(pn_id='shm_broker', register=False, shared_memory=True, channel_capacity=8)
+    sink = PyroNode(pn_id='shm_sink', broker='shm_broker', register=False, shared_memory=True)
+    got = []
+    sink.add_update_func(PyroNode.get_since_from_channel, got.append, channel=('src', 'a'))
+    sink.add_update_func(PyroNode.get_from_channel, got.append, channel=('src', 'b'))
+
+    for i in range(5):
+        broker.pn_put(float(i), ('src', 'a'))
+    broker.pn_put(np.arange(3), ('src', 'b'))
+    sink.update_all()
+    reader = sink.update_funcs[0][3]['state']['reader']
+    assert(isinstance(reader, SharedChannel) and not reader.writer)
+    assert(list(got[0]['seq']) == [0, 1, 2, 3, 4] and list(got[0]['value']) == [0, 1, 2, 3, 4])
+    assert(list(got[1]) == [0, 1, 2])
+
+    # Wraps like the broker's buffer, and reads continue from the cursor
+    for i in range(5, 15):
+        broker.pn_put(float(i), ('src', 'a'))
+    sink.update_all()
+    assert(list(got[2]['seq']) == range(7, 15))
+    assert(got[2].dtype == broker.pn_get_since(('src', 'a')).dtype)
+
+    # Widening replaces the segment, readers go back to the broker then reattach
+    path = reader.path
+    broker.pn_put([1, 2], ('src', 'a'))
+    assert(reader.closed and not os.path.exists(path))
+    sink.update_all()
+    assert(sink.update_funcs[0][3]['state']['reader'] is None)
+
+    broker.close_shared()
+    assert(not broker.pn_shared)
+
+
+def test_stats():
+
+    histogram = LatencyHistogram()
+    for duration in [0.001] * 90 + [0.1] * 10:
+        histogram.record(duration)
+    summary = histogram.summary()
+    assert(summary['count'] == 100 and 0.001 <= summary['p50'] < 0.002 and summary['max'] == 0.1)
+    assert(0.1 <= histogram.percentile(99) < 0.2)
+
+    broker = PyroNode(pn_id='stats_broker', register=False)
+    src = PyroNode(pn_id='stats_src', broker='stats_broker', register=False)
+    sink = PyroNode(pn_id='stats_sink', broker='stats_broker', register=False)
+    src.add_update_func(PyroNode.put_in_channel, lambda: 1., channel=('stats_src', 'a'))
+    sink.add_update_func(PyroNode.get_from_channel, None, channel=('stats_src', 'a'))
+    sink.add_update_func(PyroNode.get_since_from_channel, None, channel=('stats_src', 'a'))
+    for i in range(5):
+        src.update_all()
+        sink.update_all()
+
+    assert(src.pn_stats()['channels']['stats_src/a']['sent'] == 5)
+    channel = broker.pn_stats()['channels']['stats_src/a']
+    assert(channel['puts'] == 5 and channel['served'] == 10)
+    stats = sink.pn_stats()
+    channel = stats['channels']['stats_src/a']
+    assert(channel['received'] == 10 and channel['received_age']['count'] == 10)
+    assert(set(stats['calls']) == set(['pn_get_many', 'get_since_from_channel']))
+    assert(json.loads(json.dumps(stats))['pn_id'] == 'stats_sink')
+
+
+def test_broker_rules():
+
+    broker = PyroNode(pn_id='rules_broker', register=False)
+    sink = PyroNode(pn_id='rules_sink', broker='rules_broker', register=False)
+    alerts = []
+    rules = [{'hr': ['GT', 150], 'spo2': ['LT', 90]},
+             {'hr': ['GT', 120]},
+             {'spo2': ['LT', 85]}]
+    bindings = {'hr': ['bed1', 'hr'], 'spo2': ['bed1', 'spo2']}
+    broker.pn_put(98., ('bed1', 'spo2'))
+    sink.watch_rules('bed1', rules, bindings, alerts.append, names=['crash', 'tachy', 'desat'])
+
+    for hr in [80, 90, 130, 135, 160, 100]:
+        broker.pn_put(hr, ('bed1', 'hr'))
+    broker.pn_put(80., ('bed1', 'spo2'))
+    broker.pn_put(160, ('bed1', 'hr'))
+
+    # Only the transitions are published, pushed to the sink
+    for i in range(100):
+        if len(alerts) == 4:
+            break
+        time.sleep(0.01)
+    assert([alert['name'] for alert in alerts] == ['tachy', None, 'desat', 'crash'])
+    assert(alerts[0]['value'] == 130 and alerts[0]['previous'] is None)
+    assert(alerts[2]['channel'] == ['bed1', 'spo2'])
+    stats = broker.pn_stats()['rules']['bed1']
+    assert(stats['evaluated'] == 9 and stats['published'] == 4)
+
+    # Matches mode publishes every put while a rule matches
+    broker.pn_attach_rules('bed1', rules, bindings, ('bed1', 'matches'), 'matches')
+    for hr in [130, 131, 80]:
+        broker.pn_put(hr, ('bed1', 'hr'))
+    assert([alert['rule'] for alert in broker.pn_get_since(('bed1', 'matches'))['value']][-3:] == [1, 1, 2])
+    broker.pn_detach_rules('bed1')
+    assert(not broker.pn_rules and not broker._channel_rules)
+
+    # Bound channels put from different threads, the alerts still chain up
+    broker = PyroNode(pn_id='rules_threads', register=False, channel_capacity=10000)
+    broker.pn_attach_rules('bed2', rules, {'hr': ['bed2', 'hr'], 'spo2': ['bed2', 'spo2']})
+
+    def source(channel, values):
+        for i in range(2000):
+            broker.pn_put(values[i % 2], channel)
+    threads = [threading.Thread(target=source, args=(('bed2', 'hr'), (160, 80))),
+               threading.Thread(target=source, args=(('bed2', 'spo2'), (80., 98.)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    alerts = list(broker.pn_get_since(('bed2', 'alerts'))['value'])
+    assert(len(alerts) > 10)
+    assert(broker.pn_rules_stats()['bed2']['evaluated'] == 4000)
+    assert(all(a['rule'] == b['previous'] for a, b in zip(alerts, alerts[1:])))
+
+    # Beds sharing an alerts channel don't lose alerts to each other
+    beds = ['bed%d' % i for i in range(3, 7)]
+    for bed in beds:
+        broker.pn_attach_rules(bed, rules, {'hr': [bed, 'hr']}, ('ward', 'alerts'), 'matches')
+    threads = [threading.Thread(target=source, args=((bed, 'hr'), (160, 130))) for bed in beds]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    alerts = broker.pn_get_since(('ward', 'alerts'))['value']
+    assert(len(alerts) == 8000 and all(alert is not None for alert in alerts))
+
+
+def test_scheduler():
+
+    scheduler = PyroScheduler()
+    counts = {'fast': 0, 'slow': 0}
+
+    def fast():
+        counts['fast'] += 1
+
+    def slow():
+        counts['slow'] += 1
+        time.sleep(0.03)
+
+    fast_task = scheduler.add(fast, 0.01)
+    slow_task = scheduler.add(slow, 0.02)
+    scheduler.start()
+    time.sleep(0.5)
+    scheduler.stop()
+
+    # Fast runs late while slow blocks the loop, but skips rather than bursts
+    assert(10 <= counts['fast'] <= 51)
+    assert(slow_task.overruns == slow_task.runs and slow_task.missed > 0)
+    assert(fast_task.stats()['runs'] == counts['fast'])
+
+
 def test_multihost_pyronode():
 
     ns = Pyro4.locateNS()
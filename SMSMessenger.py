@@ -1,10 +1,66 @@
 # Send SMS Messages
 
 import textwrap
-import yaml
 import smtplib
+import socket
 import logging
 import os
+import threading
+import time
+import Queue
+from LazyModule import LazyModule, lazy_class_attribute
+
+yaml = LazyModule('yaml')
+
+
+class MessageFuture(object):
+
+    # Result of a queued message, the dict of refused recipients from sendmail, or
+    # the exception that stopped it from going out
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def _finish(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._finish(result=result)
+
+    def set_exception(self, exception):
+        self._finish(exception=exception)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Message not sent yet')
+        return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
 
 class SMSMessenger:
 
@@ -25,12 +81,43 @@ class SMSMessenger:
         virgin:     vmobl.com
         ''')
 
-    relays, gateways = yaml.load_all(services)
+    # Parsed from services on first use, or set beforehand with configure()
+
+    @classmethod
+    def parse_services(cls):
+        cls.relays, cls.gateways = yaml.safe_load_all(cls.services)
+        return cls.relays, cls.gateways
+
+    @lazy_class_attribute
+    def relays(cls):
+        return cls.parse_services()[0]
+
+    @lazy_class_attribute
+    def gateways(cls):
+        return cls.parse_services()[1]
 
-    def __init__(self, relay_useraddr, relay_pword, from_name=None):
+    @classmethod
+    def configure(cls, relays=None, gateways=None, services=None):
+        # Replace the relay and gateway tables, with dicts, or with yaml like services
+        if services is not None:
+            cls.services = services
+            cls.parse_services()
+        if relays is not None:
+            cls.relays = relays
+        if gateways is not None:
+            cls.gateways = gateways
+
+    # Messages are sent from a queue by pool_size sender threads, each holding one
+    # SMTP session open between messages.  A session that has died is reopened and
+    # the message tried once more.  relay_server overrides the relay looked up from
+    # the user's domain, ie, a local test server, and tls and login can be turned off
+    # for relays that don't take them.
+
+    def __init__(self, relay_useraddr, relay_pword, from_name=None, relay_server=None, tls=True,
+                 pool_size=2, queue_size=1000, keepalive=60., timeout=30.):
         tmp = relay_useraddr.split('@')
         self.relay_user = tmp[0]
-        self.relay_server = self.relays[tmp[1]]
+        self.relay_server = relay_server or self.relays[tmp[1]]
         self.relay_pword = relay_pword
         self.logger = logging.getLogger('SMSMessenger')
 
@@ -39,9 +126,117 @@ class SMSMessenger:
         else:
             self.from_addr = self.relay_user
 
+        self.tls = tls
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.queue = Queue.Queue(queue_size)
+        self.senders = []
+        self.lock = threading.Lock()
+        # Counters
+        self.sent = 0
+        self.failed = 0
+        self.connects = 0
+        self.reconnects = 0
+
+    def to_addr(self, number, carrier):
+        return '%s@%s' % (number, self.gateways[carrier])
+
     def message(self, number, carrier, msg):
-        to_addr = '%s@%s' % (number, self.gateways[carrier])
-        SMSMessenger.send_message(self.relay_server, self.relay_user, self.relay_pword, self.from_addr, to_addr, msg)
+        # Queue msg for number, or for each (number, carrier) in a list with carrier
+        # None, and return a MessageFuture without waiting.  One sendmail goes to all
+        # the recipients of a message.
+        if carrier is None:
+            to_addrs = [self.to_addr(*recipient) for recipient in number]
+        else:
+            to_addrs = [self.to_addr(number, carrier)]
+        future = MessageFuture()
+        self._start()
+        try:
+            self.queue.put_nowait((to_addrs, msg, future))
+        except Queue.Full as e:
+            self.failed += 1
+            future.set_exception(e)
+        return future
+
+    def _start(self):
+        if len(self.senders) < self.pool_size:
+            with self.lock:
+                while len(self.senders) < self.pool_size:
+                    thread = threading.Thread(target=self._send_loop)
+                    thread.setDaemon(True)
+                    thread.start()
+                    self.senders.append(thread)
+
+    def connect(self):
+        server = smtplib.SMTP(self.relay_server, timeout=self.timeout)
+        if self.tls:
+            server.starttls()
+        if self.relay_pword:
+            server.login(self.relay_user, self.relay_pword)
+        self.connects += 1
+        return server
+
+    @staticmethod
+    def disconnect(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, socket.error):
+            server.close()
+
+    def _send(self, server, to_addrs, msg):
+        # Returns the server, which may be a new session
+        if server is None:
+            server = self.connect()
+        try:
+            return server, server.sendmail(self.from_addr, to_addrs, msg.encode(encoding='UTF-8'))
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # Idle session dropped by the relay
+            server.close()
+            self.reconnects += 1
+            server = self.connect()
+            return server, server.sendmail(self.from_addr, to_addrs, msg.encode(encoding='UTF-8'))
+
+    def _send_loop(self):
+        server = None
+        while 1:
+            try:
+                item = self.queue.get(timeout=self.keepalive if server else None)
+            except Queue.Empty:
+                # Keep the session warm, or drop it if the relay already has
+                try:
+                    server.noop()
+                except (smtplib.SMTPException, socket.error):
+                    server.close()
+                    server = None
+                continue
+            if item is None:
+                if server:
+                    self.disconnect(server)
+                return
+            to_addrs, msg, future = item
+            try:
+                server, refused = self._send(server, to_addrs, msg)
+            except Exception as e:
+                self.logger.warning('Failed to send to {0}: {1!r}'.format(', '.join(to_addrs), e))
+                if server:
+                    server.close()
+                server = None
+                self.failed += 1
+                future.set_exception(e)
+            else:
+                self.sent += 1
+                future.set_result(refused)
+
+    def close(self, wait=True):
+        # Send what's queued, then stop the senders and end their sessions
+        with self.lock:
+            senders, self.senders = self.senders, []
+        for thread in senders:
+            self.queue.put(None)
+        if wait:
+            for thread in senders:
+                thread.join()
 
     @staticmethod
     def send_message(relay_server, relay_username, relay_password, from_addr, to_addr, msg):
@@ -55,6 +250,177 @@ class SMSMessenger:
         server.quit()
 
 
+class TokenBucket(object):
+
+    # Allows burst sends at once, refilling at rate per second
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.time = None
+
+    def ready(self, now):
+        # Whether take() would succeed, without taking
+        if self.time is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        return self.tokens >= 1
+
+    def take(self, now):
+        if self.ready(now):
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AlertDispatcher(object):
+
+    # Sits between rule matching and an SMSMessenger.  Alerts are (recipient, key,
+    # text), where recipient is a (number, carrier) and key names the alert, ie, the
+    # matched rule.  An alert repeating a key sent to the same recipient within
+    # dedup_window is suppressed.  Alerts for a recipient are held for
+    # coalesce_window and then merged into as many as fit one SMS, and sends are
+    # limited by a token bucket per recipient and one for the relay.  Anything held
+    # back by the limits, or that didn't fit, stays pending and merges with later
+    # alerts.
+    #
+    # poll(now) does the sending and may be driven by the caller's own loop, or by
+    # start() on a thread.
+
+    separator = ' | '
+
+    def __init__(self, messenger, dedup_window=300., coalesce_window=5.,
+                 recipient_rate=(1 / 60., 3), relay_rate=(1., 10), clock=time.time):
+        self.messenger = messenger
+        self.dedup_window = dedup_window
+        self.coalesce_window = coalesce_window
+        self.recipient_rate = recipient_rate
+        self.relay_bucket = TokenBucket(*relay_rate)
+        self.recipient_buckets = {}
+        self.clock = clock
+        # recipient -> (time of first pending alert, [(key, text)])
+        self.pending = {}
+        # (recipient, key) -> time last sent
+        self.last_sent = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        # Counters
+        self.received = 0
+        self.suppressed = 0
+        self.merged = 0
+        self.deferred = 0
+        self.sent = 0
+
+    @staticmethod
+    def max_length(text):
+        # GSM text fits 160 characters, anything else is sent as UCS-2 and only fits 70
+        try:
+            text.encode('ascii')
+            return 160
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            return 70
+
+    def alert(self, recipient, key, text, now=None):
+        # Returns whether the alert was kept for sending
+        now = self.clock() if now is None else now
+        recipient = tuple(recipient)
+        with self.lock:
+            self.received += 1
+            sent = self.last_sent.get((recipient, key))
+            if sent is not None and now - sent < self.dedup_window:
+                self.suppressed += 1
+                return False
+            first, alerts = self.pending.setdefault(recipient, (now, []))
+            for i, (pending_key, pending_text) in enumerate(alerts):
+                if pending_key == key:
+                    # Keep the newest text
+                    alerts[i] = (key, text)
+                    self.suppressed += 1
+                    return False
+            alerts.append((key, text))
+            return True
+
+    def compose(self, alerts):
+        # One SMS worth of alert texts, and how many of the alerts it covers.  When
+        # not all fit, a note says how many are still to come.
+        texts = [text for key, text in alerts]
+        limit = self.max_length(self.separator.join(texts))
+        message = ''
+        for n, text in enumerate(texts):
+            candidate = text if not n else message + self.separator + text
+            if len(candidate) > limit:
+                break
+            message = candidate
+        else:
+            return message, len(texts)
+        # Note the rest, dropping texts until the note fits
+        while n:
+            more = ' (+{0} more)'.format(len(texts) - n)
+            if len(message) + len(more) <= limit:
+                return message + more, n
+            n -= 1
+            message = self.separator.join(texts[:n])
+        return texts[0][:limit], 1
+
+    def poll(self, now=None):
+        # Send what's due, returns the messenger's futures for the texts sent
+        now = self.clock() if now is None else now
+        futures = []
+        with self.lock:
+            for recipient, (first, alerts) in self.pending.items():
+                if now - first < self.coalesce_window:
+                    continue
+                bucket = self.recipient_buckets.get(recipient)
+                if bucket is None:
+                    bucket = self.recipient_buckets[recipient] = TokenBucket(*self.recipient_rate)
+                # Only spend a token when both allow the send
+                if not bucket.ready(now) or not self.relay_bucket.ready(now):
+                    self.deferred += 1
+                    continue
+                bucket.take(now)
+                self.relay_bucket.take(now)
+                message, n = self.compose(alerts)
+                if n < len(alerts):
+                    # Still due, for the next token
+                    self.pending[recipient] = (first, alerts[n:])
+                else:
+                    del self.pending[recipient]
+                for key, text in alerts[:n]:
+                    self.last_sent[(recipient, key)] = now
+                self.merged += n - 1
+                self.sent += 1
+                futures.append(self.messenger.message(recipient[0], recipient[1], message))
+            # Forget sends that no longer dedup anything
+            for sent_key, sent in self.last_sent.items():
+                if now - sent >= self.dedup_window:
+                    del self.last_sent[sent_key]
+        return futures
+
+    def start(self, interval=1.):
+        def poll_loop():
+            while self.thread is not None:
+                try:
+                    self.poll()
+                except Exception:
+                    logging.getLogger('AlertDispatcher').exception('Poll failed')
+                time.sleep(interval)
+        self.thread = threading.Thread(target=poll_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.thread = None
+
+    def stats(self):
+        return {'received': self.received,
+                'suppressed': self.suppressed,
+                'merged': self.merged,
+                'deferred': self.deferred,
+                'sent': self.sent,
+                'pending': sum(len(alerts) for first, alerts in self.pending.values())}
+
+
 def test_sms():
     relay_user = os.environ['relay_user']
     relay_pword = os.environ['relay_pword']
@@ -63,7 +429,111 @@ def test_sms():
     carrier = os.environ['carrier']
 
     m = SMSMessenger( relay_user, relay_pword, from_name )
-    m.message( phone_number, carrier, 'MAX ALERT | Room 1 | V.TACH | Current HR 120 bpm | Current SpO2 85 % ' )
+    m.message( phone_number, carrier, 'MAX ALERT | Room 1 | V.TACH | Current HR 120 bpm | Current SpO2 85 % ' ).result()
+    m.close()
+
+
+def test_alert_dispatcher():
+
+    class Messenger(object):
+        def __init__(self):
+            self.texts = []
+        def message(self, number, carrier, msg):
+            self.texts.append((number, carrier, msg))
+
+    m = Messenger()
+    d = AlertDispatcher(m, dedup_window=300., coalesce_window=5., recipient_rate=(1 / 60., 2), relay_rate=(1., 10))
+    doctor = ('5550001111', 'att')
+    nurse = ('5550002222', 'verizon')
+
+    # A rule matching every second for an hour, to two recipients
+    for t in range(3600):
+        for recipient in [doctor, nurse]:
+            d.alert(recipient, 'vtach', 'V.TACH | Room 1 | HR 180', now=t)
+        d.poll(now=t)
+    assert(d.sent == len(m.texts) == 2 * 12)
+    assert(d.suppressed == 2 * 3600 - d.sent)
+
+    # Alerts close together go out as one text, no longer than an SMS
+    m.texts = []
+    for i in range(20):
+        d.alert(doctor, 'low_spo2_%d' % i, 'LOW SPO2 | Room %d | SpO2 85 %%' % i, now=4000)
+    d.poll(now=4002)
+    assert(not m.texts)
+    d.poll(now=4005)
+    assert(len(m.texts) == 1 and len(m.texts[0][2]) <= 160 and m.texts[0][2].endswith('more)'))
+    # The rest wait for the next token, and aren't deduped meanwhile
+    n = d.merged + 1
+    assert(d.stats()['pending'] == 20 - n and m.texts[0][2].endswith('(+{0} more)'.format(20 - n)))
+    assert(d.alert(doctor, 'low_spo2_19', 'LOW SPO2 | Room 19 | SpO2 84 %', now=4006) is False)
+    assert(d.pending[doctor][1][-1][1].endswith('84 %'))
+    t = 4005
+    while d.stats()['pending']:
+        t += 60
+        d.poll(now=t)
+    texts = ' | '.join(text for number, carrier, text in m.texts)
+    assert(all('Room %d |' % i in texts for i in range(20)) and d.merged == 20 - len(m.texts))
+
+    # Rate limited sends wait and pick up later alerts
+    m.texts = []
+    bucket = d.recipient_buckets[doctor]
+    bucket.tokens, bucket.time = 1., t
+    d.alert(doctor, 'apnea', 'APNEA | Room 2', now=t + 5)
+    d.poll(now=t + 10)
+    assert(len(m.texts) == 1)
+    d.alert(doctor, 'brady', 'BRADY | Room 2', now=t + 15)
+    d.poll(now=t + 20)
+    d.alert(doctor, 'asystole', 'ASYSTOLE | Room 2', now=t + 25)
+    assert(d.deferred and len(m.texts) == 1)
+    d.poll(now=t + 95)
+    assert(len(m.texts) == 2 and m.texts[1][2] == 'BRADY | Room 2 | ASYSTOLE | Room 2')
+    assert(AlertDispatcher.max_length(u'Caf\xe9') == 70)
+
+    # A relay out of tokens doesn't use up the recipient's
+    d = AlertDispatcher(m, coalesce_window=0., recipient_rate=(1 / 60., 3), relay_rate=(1., 1))
+    d.relay_bucket.take(0)
+    for t in range(3):
+        d.alert(nurse, 'tachy_%d' % t, 'TACHY | Room 3', now=0)
+        d.poll(now=0)
+    assert(d.sent == 0 and d.recipient_buckets[nurse].tokens == 3)
+
+
+def test_sms_pool():
+    import asyncore
+    import smtpd
+
+    class Relay(smtpd.SMTPServer):
+        def __init__(self):
+            smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+            self.messages = []
+            self.sessions = 0
+        def handle_accept(self):
+            self.sessions += 1
+            smtpd.SMTPServer.handle_accept(self)
+        def process_message(self, peer, mailfrom, rcpttos, data):
+            self.messages.append((rcpttos, data))
+
+    relay = Relay()
+    loop = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.01})
+    loop.setDaemon(True)
+    loop.start()
+
+    m = SMSMessenger('alerts@gmail.com', None, relay_server='127.0.0.1:%d' % relay.socket.getsockname()[1],
+                     tls=False, pool_size=2)
+    futures = [m.message('555000%04d' % i, 'att', 'ALERT %d' % i) for i in range(10)]
+    futures.append(m.message([('5550001111', 'att'), ('5550002222', 'verizon')], None, 'ALERT ALL'))
+    assert(all(future.result(5) == {} for future in futures))
+    assert(len(relay.messages) == 11 and relay.sessions <= 2)
+    assert(relay.messages[-1][0] == ['5550001111@txt.att.net', '5550002222@vtext.com'])
+
+    # Sessions dropped by the relay are reopened
+    for channel in list(asyncore.socket_map.values()):
+        if channel is not relay:
+            channel.close()
+    assert(m.message('5550003333', 'att', 'AGAIN').result(5) == {})
+    assert(m.reconnects == 1)
+    m.close()
+    relay.close()
 
 
 if __name__ == "__main__":
@@ -3,60 +3,263 @@
 
 import warnings
 import logging
-from collections import deque
+import operator as op
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque, OrderedDict
+from functools import partial
+from LazyModule import LazyModule
+
+# Only the columnar and trend code needs numpy, so rule matching alone doesn't load it
+np = LazyModule('numpy')
+
+
+class VariableRegistry(object):
+
+    # Interns VariableTypes by name.  Lookups of existing names are a plain dict read
+    # with no lock; creating a name takes the lock and inserts once, so the first
+    # definition's units and dtype stick.  Each registry hands out its own ids.
+    #
+    # Registries can be scoped per rule engine or test with "with registry:", which
+    # makes it the current registry for the calling thread.
+
+    _local = threading.local()
+
+    def __init__(self, name=None):
+        self.name = name
+        self.variables = {}
+        # Variables by id, the small int that indexes value buffers
+        self.by_id = []
+        # Bumped by reset(), ids are only valid for variables of the same generation
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def current(cls):
+        stack = getattr(cls._local, 'stack', None)
+        if stack:
+            return stack[-1]
+        return VariableRegistry.default
+
+    def __enter__(self):
+        stack = getattr(VariableRegistry._local, 'stack', None)
+        if stack is None:
+            stack = VariableRegistry._local.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        VariableRegistry._local.stack.pop()
+
+    def get(self, name):
+        return self.variables.get(name)
+
+    def insert(self, cls, name, units, dtype):
+        with self._lock:
+            variable = self.variables.get(name)
+            if variable is None:
+                variable = object.__new__(cls)
+                variable.name = name
+                variable.units = units
+                variable.dtype = dtype
+                variable.registry = self
+                variable.generation = self.generation
+                variable.id = len(self.by_id)
+                # Publish the id slot before the name becomes visible to readers
+                self.by_id.append(variable)
+                self.variables[name] = variable
+            return variable
+
+    def reset(self):
+        # Forget every variable.  Ids start over, so existing VariableTypes, ie, in
+        # rules built before, are then looked up by name like foreign variables.
+        # Swapped rather than cleared for lock-free readers.
+        with self._lock:
+            self.generation += 1
+            self.by_id = []
+            self.variables = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __repr__(self):
+        return '<ss:registry: %s (%d)>' % (self.name, len(self.by_id))
+
+
+VariableRegistry.default = VariableRegistry('default')
 
 
 class VariableType(object):
 
-    # Need a list of generated variables, so we only create a new one if neccesary
+    # Need a list of generated variables, so we only create a new one if neccesary.
+    # Instances are interned in a VariableRegistry, the current one unless a
+    # registry= is given, and looking up an existing name allocates nothing.
 
-    _dict = dict()
+    def __new__(cls, **kwargs):
+        registry = kwargs.get('registry') or VariableRegistry.current()
+        name = kwargs.get('name', 'var')
+        variable = registry.variables.get(name)
+        if variable is not None:
+            return variable
+        # Basically decorators for outputs
+        return registry.insert(cls, name, kwargs.get('units', 'arbs'), kwargs.get('dtype', 'float'))
 
     def __init__(self, **kwargs):
-        super(VariableType, self).__init__()
-        # Basically decorators for outputs
-        self.name  = kwargs.get('name',  'var')
-        self.units = kwargs.get('units', 'arbs')
-        self.dtype = kwargs.get('dtype', 'float')
-        VariableType._dict[self.name] = self
+        # Everything is set once by VariableRegistry.insert, lookups must not re-init
+        pass
 
-    # This is somewhat bad practice b/c it will re-init every time, but it's easy to implement
-    # and the side effect is irrelevant in this context
-    def __new__(cls, **kwargs):
-        name = kwargs.get('name')
-        if VariableType._dict.get(name):
-            return VariableType._dict[name]
-        else:
-            return super(VariableType, cls).__new__(cls)
+    # Sample history for trending conditions, see track()
+    history = None
+
+    def track(self, history_len=60, **kwargs):
+        # Start keeping a bounded history of samples for TLT/TGT conditions.  Only
+        # replaced if the requested length changes.
+        if self.history is None or self.history.history_len != history_len:
+            self.history = TrendHistory(history_len, **kwargs)
+        return self.history
+
+    def push(self, value, timestamp=None):
+        if self.history is not None:
+            self.history.push(value, timestamp)
 
     def __repr__(self):
         return '<ss:var: %s>' % self.name
 
 
+class TrendHistory(object):
+
+    # Bounded sample history for one variable, preallocated as numpy ring buffers.
+    # Running sums for a sliding-window least squares fit and Holt (EWMA level and
+    # trend) state are updated in O(1) per sample, so predict() never refits the
+    # window.  Times are seconds; the sums are rebuilt from the buffer once per window
+    # to shed float drift.
+
+    predictors = ('linear', 'ewma', 'last')
+
+    def __init__(self, history_len=60, predictor='linear', alpha=0.3, beta=0.1):
+        if predictor not in TrendHistory.predictors:
+            raise ValueError('No predictor defined for %s' % predictor)
+        self.history_len = int(history_len)
+        self.predictor = predictor
+        self.alpha = alpha
+        self.beta = beta
+        self.times = np.zeros(self.history_len)
+        self.values = np.zeros(self.history_len)
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.head = 0
+        self.pushes = 0
+        self.t0 = None
+        self.sum_t = self.sum_v = self.sum_tt = self.sum_tv = 0.
+        self.level = self.trend = None
+        self.last_time = self.last_value = None
+
+    def __len__(self):
+        return self.count
+
+    def push(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        value = float(value)
+        if self.t0 is None:
+            self.t0 = timestamp
+        t = timestamp - self.t0
+
+        if self.count == self.history_len:
+            # Evict the oldest sample from the running sums
+            old_t = float(self.times[self.head])
+            old_v = float(self.values[self.head])
+            self.sum_t -= old_t
+            self.sum_v -= old_v
+            self.sum_tt -= old_t * old_t
+            self.sum_tv -= old_t * old_v
+        else:
+            self.count += 1
+        self.times[self.head] = t
+        self.values[self.head] = value
+        self.sum_t += t
+        self.sum_v += value
+        self.sum_tt += t * t
+        self.sum_tv += t * value
+        self.head = (self.head + 1) % self.history_len
+
+        if self.level is None:
+            self.level = value
+            self.trend = 0.
+        else:
+            dt = timestamp - self.last_time
+            if dt > 0:
+                level = self.alpha * value + (1 - self.alpha) * (self.level + self.trend * dt)
+                self.trend = self.beta * (level - self.level) / dt + (1 - self.beta) * self.trend
+                self.level = level
+            else:
+                self.level = self.alpha * value + (1 - self.alpha) * self.level
+        self.last_time = timestamp
+        self.last_value = value
+
+        self.pushes += 1
+        if self.pushes % self.history_len == 0:
+            self._rebase()
+
+    def _rebase(self):
+        # Buffer is full here, so every slot is live
+        shift = float(self.times[self.head])
+        self.times -= shift
+        self.t0 += shift
+        self.sum_t = float(self.times.sum())
+        self.sum_v = float(self.values.sum())
+        self.sum_tt = float(np.dot(self.times, self.times))
+        self.sum_tv = float(np.dot(self.times, self.values))
+
+    def window(self):
+        # (times, values) in arrival order, as copies
+        if self.count < self.history_len:
+            return self.times[:self.count] + self.t0, self.values[:self.count].copy()
+        order = np.roll(np.arange(self.history_len), -self.head)
+        return self.times[order] + self.t0, self.values[order]
+
+    def predict(self, prediction_range, predictor=None):
+        # Value expected prediction_range seconds after the last sample
+        if not self.count:
+            return None
+        predictor = predictor or self.predictor
+        if predictor == 'linear':
+            n = self.count
+            denom = n * self.sum_tt - self.sum_t * self.sum_t
+            if n < 2 or denom <= 0:
+                return self.last_value
+            slope = (n * self.sum_tv - self.sum_t * self.sum_v) / denom
+            intercept = (self.sum_v - slope * self.sum_t) / n
+            return intercept + slope * (self.last_time - self.t0 + prediction_range)
+        elif predictor == 'ewma':
+            return self.level + self.trend * prediction_range
+        elif predictor == 'last':
+            return self.last_value
+        else:
+            raise ValueError('No predictor defined for %s' % predictor)
+
+
 class TypedValue(object):
 
+    __slots__ = ('variable', 'value')
+
     def __init__(self, variable, value):
         if isinstance(variable, basestring):
             # It's just a name
             variable = VariableType(name=variable)
         self.variable = variable
         self.value = value
-        # self.history = deque(maxlen=history_len)
-        # self.prediction_func = prediction_func
 
-    # @property
-    # def value(self):
-    #     return self.history[0]
-    #
-    # @value.setter
-    # def value(self, _value):
-    #     self.history.push(_value)
-    #
-    # def predict(self, range):
-    #     if self.prediction_func:
-    #         return self.prediction_func(self.history, range)
-    #     else:
-    #         return self.value
+    def predict(self, prediction_range):
+        # Falls back on the current value for untracked variables
+        history = self.variable.history
+        if history is None or not len(history):
+            return self.value
+        return history.predict(prediction_range)
 
     def __eq__(self, other):
         # Only one instance of a var allowed in the set
@@ -72,41 +275,105 @@ class TypedValue(object):
 
 class TypedCondition(object):
 
+    __slots__ = ('variable', 'value', 'value1', 'operator', 'prediction_range', 'predicate')
+
+    operators = ('GT', 'GTE', 'LT', 'LTE', 'EQ', 'NEQ', 'IN', 'TLT', 'TGT')
+
+    formats = {'GT':  '%(name)s>%(value)g',
+               'GTE': '%(name)s>=%(value)g',
+               'LT':  '%(name)s<%(value)g',
+               'LTE': '%(name)s<=%(value)g',
+               'EQ':  '%(name)s==%(value)g',
+               'NEQ': '%(name)s!=%(value)g',
+               'IN':  '%(value)g<%(name)s<%(upper)g',
+               'TLT': '%(name)s..<%(value)g',
+               'TGT': '%(name)s..>%(value)g'}
+
     def __init__(self, variable, operator, value, *args):
         if isinstance(variable, basestring):
             # It's just a name
             variable = VariableType(name=variable)
+        if operator not in TypedCondition.operators:
+            raise ValueError('No operation defined for %s' % operator)
+        if operator == 'IN' and not args:
+            raise ValueError('IN needs a lower and an upper bound')
         self.variable = variable
         self.value = value
         self.value1 = args
         self.operator = operator
-        # self.prediction_range = prediction_range
+        # Trend conditions are ('TLT', threshold, seconds ahead)
+        if operator in ('TLT', 'TGT') and args:
+            self.prediction_range = args[0]
+        else:
+            self.prediction_range = 0
+        self.predicate = self._compile()
+
+    def _compile(self):
+        # Bind the comparison once, so evaluation is a single call with no dispatch.
+        # Note the operands are swapped for partial, ie, GT is value < x.
+        value = self.value
+        if self.operator == 'GT':
+            return partial(op.lt, value)
+        elif self.operator == 'GTE':
+            return partial(op.le, value)
+        elif self.operator == 'LT':
+            return partial(op.gt, value)
+        elif self.operator == 'LTE':
+            return partial(op.ge, value)
+        elif self.operator == 'NEQ':
+            return partial(op.ne, value)
+        elif self.operator == 'EQ':
+            if not self.value1:
+                return partial(op.eq, value)
+            alternatives = (value,) + tuple(self.value1)
+            try:
+                lookup = frozenset(alternatives).__contains__
+            except TypeError:
+                # Unhashable alternatives
+                return alternatives.__contains__
+
+            def contains(x):
+                try:
+                    return lookup(x)
+                except TypeError:
+                    # Unhashable value, ie, a list, so equal to none of them
+                    return alternatives.__contains__(x)
+            return contains
+        elif self.operator == 'IN':
+            upper = self.value1[0]
+            return lambda x: value < x < upper
+        else:
+            # Trending, compares the predicted value against the threshold
+            compare = op.lt if self.operator == 'TLT' else op.gt
+            variable = self.variable
+            prediction_range = self.prediction_range
+
+            def trend(x):
+                history = variable.history
+                if history is not None and len(history):
+                    x = history.predict(prediction_range)
+                return compare(x, value)
+            return trend
 
     def satisfied_by_any(self, typed_value_set):
         if isinstance(typed_value_set, dict):
             typed_value_set = TypedValueSet(typed_value_set)
-        for typed_value in typed_value_set.typed_values:
-            if self.comparable(typed_value):
-                if self.satisfied_by(typed_value):
-                    return True
-        return False
+        value = typed_value_set.get(self.variable)
+        if value is None:
+            return False
+        return self.predicate(value)
 
     def not_satisfied_by_any(self, typed_value_set):
         if isinstance(typed_value_set, dict):
             typed_value_set = TypedValueSet(typed_value_set)
-        for typed_value in typed_value_set.typed_values:
-            if self.comparable(typed_value):
-                if not self.satisfied_by(typed_value):
-                    return True
-        return False
+        value = typed_value_set.get(self.variable)
+        if value is None:
+            return False
+        return not self.predicate(value)
 
     def comparable(self, typed_value):
-        if typed_value.variable.name != self.variable.name:
-            # logging.debug('%s IS NOT comparable to %s' % (self.variable.name, typed_value.variable.name))
-            return False
-        else:
-            # logging.debug('%s IS comparable to %s' % (self.variable.name, typed_value.variable.name))
-            return True
+        variable = typed_value.variable
+        return variable is self.variable or variable.name == self.variable.name
 
     def satisfied_by(self, typed_value):
 
@@ -116,91 +383,244 @@ class TypedCondition(object):
             warnings.warn(err)
             return False
 
+        return self.predicate(typed_value.value)
+
+    def satisfied_by_value(self, value):
+        # Same as satisfied_by for a bare value of this variable
+        return self.predicate(value)
+
+    def satisfied_by_array(self, column):
+        # Vectorized satisfied_by over a column of values for this variable
         if self.operator == 'GT':
-            return typed_value.value > self.value
+            return column > self.value
         elif self.operator == 'GTE':
-            return typed_value.value >= self.value
+            return column >= self.value
         elif self.operator == 'LT':
-            return typed_value.value < self.value
+            return column < self.value
         elif self.operator == 'LTE':
-            return typed_value.value <= self.value
+            return column <= self.value
         elif self.operator == 'EQ':
-            if self.value1 is None:
-                return typed_value.value == self.value
-            elif not isinstance(self.value1, (list, tuple)):
-                return typed_value.value == self.value or typed_value.value == self.value1
-            else:  # It must be a list
-                if typed_value.value == self.value:
-                    return True
-                for value in self.value1:
-                    if typed_value.value == value:
-                        return True
-                return False
+            return np.in1d(column, (self.value,) + tuple(self.value1))
         elif self.operator == 'NEQ':
-            return typed_value.value != self.value
+            return column != self.value
         elif self.operator == 'IN':
-            return self.value < typed_value.value < self.value1
-        elif self.operator == 'TLT':  # Trending less than
-            if hasattr(typed_value, 'predict'):
-                return self.value < typed_value.predict(self.prediction_range)
-            else:
-                return False
-        elif self.operator == 'TGT':  # Trending greater than
-            if hasattr(typed_value, 'predict'):
-                return self.value > typed_value.predict(self.prediction_range)
-            else:
-                return False
+            return (column > self.value) & (column < self.value1[0])
+        elif self.operator in ('TLT', 'TGT'):
+            # Same as satisfied_by: the predicted value if the variable has a history,
+            # otherwise each value itself
+            history = self.variable.history
+            if history is not None and len(history):
+                column = np.where(column == column, history.predict(self.prediction_range), np.nan)
+            return column < self.value if self.operator == 'TLT' else column > self.value
         else:
             warnings.warn('No operation defined for %s' % self.operator)
-            return False
+            return np.zeros(len(column), dtype=bool)
 
     def __repr__(self):
-        if self.operator == 'GT':
-            return '<ss:tc: %s>%g>' % (self.variable.name, self.value)
-        elif self.operator == 'GTE':
-            return '<ss:tc: %s>=%g>' % (self.variable.name, self.value)
-        elif self.operator == 'LT':
-            return '<ss:tc: %s<%g>' % (self.variable.name, self.value)
-        elif self.operator == 'LTE':
-            return '<ss:tc: %s<=%g>' % (self.variable.name, self.value)
-        elif self.operator == 'EQ':
-            return '<ss:tc: %s==%g>' % (self.variable.name, self.value)
-        elif self.operator == 'NEQ':
-            return '<ss:tc: %s!=%g>' % (self.variable.name, self.value)
-        elif self.operator == 'IN':
-            return '<ss:tc: %g<%s<%g>' % (self.value, self.variable.name, self.value1)
-        elif self.operator == 'TLT':
-            return '<ss:tc: %s..<%g>' % (self.variable.name, self.value)
-        elif self.operator == 'TGT':
-            return '<ss:tc: %g..>%g>' % (self.variable.name, self.value)
-        else:
-            warnings.warn('No operation defined for %s' % self.operator)
+        upper = self.value1[0] if self.operator == 'IN' else None
+        return '<ss:tc: %s>' % (TypedCondition.formats[self.operator] %
+                                {'name': self.variable.name, 'value': self.value, 'upper': upper})
+
+
+class TypedValueList(list):
+
+    # TypedValueSet.typed_values, for callers of the list it used to be.  Appending,
+    # extending and removing go through to the set, other changes aren't allowed.
+
+    def __init__(self, value_set, items):
+        list.__init__(self, items)
+        self.value_set = value_set
+
+    def append(self, typed_value):
+        self.value_set.add(typed_value)
+        list.append(self, typed_value)
+
+    def extend(self, typed_values):
+        for typed_value in typed_values:
+            self.append(typed_value)
+
+    def remove(self, typed_value):
+        list.remove(self, typed_value)
+        self.value_set.remove(typed_value.variable)
+
+    def _read_only(self, *args):
+        raise TypeError('Use TypedValueSet.add() and remove()')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = _read_only
+    insert = pop = sort = reverse = _read_only
 
 
 class TypedValueSet(object):
 
-    def __init__(self, items={}):
-        self.typed_values = []
-        for variable, value in items.iteritems():
-            item = TypedValue(variable, value)
-            self.typed_values.append(item)
+    # Values live in a float array indexed by VariableType.id, with NaN marking
+    # variables that are not in the set, so lookup by variable is O(1) and a frame
+    # costs one small buffer instead of a TypedValue per value.  Anything that is not
+    # a plain number (bools, strings) goes in a side dict, and ints are noted in a side
+    # set so they come back as they were added.
+
+    __slots__ = ('values', 'objects', 'ints', 'registry')
+
+    _missing = array('d', [float('nan')])
+
+    def __init__(self, items={}, registry=None):
+        if isinstance(items, TypedValueSet):
+            self.registry = items.registry
+            self.values = array('d', items.values)
+            self.objects = dict(items.objects) if items.objects else None
+            self.ints = set(items.ints) if items.ints else None
+            return
+
+        self.registry = registry or VariableRegistry.current()
+        self.values = TypedValueSet._missing * len(self.registry)
+        self.objects = None
+        self.ints = None
+        if isinstance(items, dict):
+            for variable, value in items.iteritems():
+                self.add(variable, value)
+        else:
+            for item in items:
+                self.add(item)
+
+    def _variable(self, variable):
+        if isinstance(variable, basestring):
+            # It's just a name
+            return VariableType(name=variable, registry=self.registry)
+        if variable.registry is not self.registry or variable.generation != self.registry.generation:
+            # Ids are per registry and generation, so go by name
+            return VariableType(name=variable.name, registry=self.registry)
+        return variable
+
+    def add(self, variable, value=None):
+        # Takes a TypedValue, or a variable and value
+        if isinstance(variable, TypedValue):
+            variable, value = variable.variable, variable.value
+        variable = self._variable(variable)
+        i = variable.id
+        if i >= len(self.values):
+            self.values.extend(TypedValueSet._missing * (i + 1 - len(self.values)))
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            self.values[i] = value
+            if self.objects:
+                self.objects.pop(i, None)
+            if not isinstance(value, float):
+                if self.ints is None:
+                    self.ints = set()
+                self.ints.add(i)
+            elif self.ints:
+                self.ints.discard(i)
+        else:
+            self.values[i] = TypedValueSet._missing[0]
+            if self.ints:
+                self.ints.discard(i)
+            if self.objects is None:
+                self.objects = {}
+            self.objects[i] = value
+
+    def remove(self, variable):
+        i = self._variable(variable).id
+        if i < len(self.values):
+            self.values[i] = TypedValueSet._missing[0]
+        if self.objects:
+            self.objects.pop(i, None)
+        if self.ints:
+            self.ints.discard(i)
+
+    def get(self, variable, default=None):
+        i = self._variable(variable).id
+        if i < len(self.values):
+            value = self.values[i]
+            if value == value:
+                if self.ints and i in self.ints:
+                    return int(value)
+                return value
+        if self.objects:
+            return self.objects.get(i, default)
+        return default
+
+    def __contains__(self, variable):
+        return self.get(variable) is not None
+
+    def __len__(self):
+        return len(self.as_dict())
+
+    def items(self):
+        # (VariableType, value) pairs in id order
+        by_id = self.registry.by_id
+        for i, value in enumerate(self.values):
+            if value == value:
+                yield by_id[i], int(value) if self.ints and i in self.ints else value
+            elif self.objects and i in self.objects:
+                yield by_id[i], self.objects[i]
+
+    @property
+    def typed_values(self):
+        # Built on demand, changes to it are passed on to the set
+        return TypedValueList(self, [TypedValue(variable, value) for variable, value in self.items()])
 
     def __repr__(self):
         return repr(self.typed_values)
 
     def as_dict(self):
         d = {}
-        for item in self.typed_values:
-            d[item.variable.name] = item.value
+        for variable, value in self.items():
+            d[variable.name] = value
         return d
 
 
+class TypedValueFrames(object):
+
+    # Columnar block of value frames, ie, recorded vitals, for batch evaluation.  Takes
+    # a dict of variable to array or a numpy structured array.  NaN in a float column
+    # marks a variable that was missing from that frame.
+
+    def __init__(self, frames):
+        if isinstance(frames, TypedValueFrames):
+            self.columns = frames.columns
+            self.present = frames.present
+            self.length = frames.length
+            return
+
+        if isinstance(frames, np.ndarray) and frames.dtype.names:
+            items = [(name, frames[name]) for name in frames.dtype.names]
+        else:
+            items = frames.items()
+
+        self.columns = {}
+        self.present = {}
+        self.length = None
+        for variable, column in items:
+            if not isinstance(variable, basestring):
+                variable = variable.name
+            column = np.asarray(column)
+            if self.length is None:
+                self.length = len(column)
+            elif len(column) != self.length:
+                raise ValueError('Column %s has %d frames, expected %d' % (variable, len(column), self.length))
+            self.columns[variable] = column
+            if column.dtype.kind == 'f':
+                self.present[variable] = ~np.isnan(column)
+            else:
+                self.present[variable] = None
+        if self.length is None:
+            self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return '<ss:frames: %d x %s>' % (self.length, sorted(self.columns))
+
+
 class TypedConditionSet(object):
     def __init__(self, items={}):
         self.typed_conditions = []
-        for variable, condition in items.iteritems():
-            item = TypedCondition(variable, *condition)
-            self.typed_conditions.append(item)
+        if isinstance(items, dict):
+            for variable, condition in items.iteritems():
+                item = TypedCondition(variable, *condition)
+                self.typed_conditions.append(item)
+        else:
+            # Already a list of TypedConditions
+            self.typed_conditions.extend(items)
 
     def satisfied_by(self, typed_value_set):
         for condition in self.typed_conditions:
@@ -215,32 +635,641 @@ class TypedConditionSet(object):
                 return False
         return True
 
+    def satisfied_by_frames(self, frames):
+        # Boolean array, one entry per frame
+        frames = TypedValueFrames(frames)
+        result = np.ones(frames.length, dtype=bool)
+        for condition in self.typed_conditions:
+            column = frames.columns.get(condition.variable.name)
+            if column is None:
+                result[:] = False
+                break
+            with np.errstate(invalid='ignore'):
+                result &= condition.satisfied_by_array(column)
+            present = frames.present[condition.variable.name]
+            if present is not None:
+                result &= present
+        return result
+
+    def satisfiable_by_frames(self, frames):
+        frames = TypedValueFrames(frames)
+        result = np.ones(frames.length, dtype=bool)
+        for condition in self.typed_conditions:
+            column = frames.columns.get(condition.variable.name)
+            if column is None:
+                continue
+            with np.errstate(invalid='ignore'):
+                failed = ~condition.satisfied_by_array(column)
+            present = frames.present[condition.variable.name]
+            if present is not None:
+                failed &= present
+            result &= ~failed
+        return result
+
     def __repr__(self):
         return repr(self.typed_conditions)
 
 # Can extend this to "rules" by subclassing TypedConditionSet and adding priority, etc.
 class OrderedConditionSets(object):
 
-    def __init__(self, conditions=None):
+    def __init__(self, conditions=None, cache_size=None, registry=None):
 
         self.condition_sets = []
+        # Variables named in rules and values are interned here
+        self.registry = registry or VariableRegistry.current()
+        # Compiled rule index, built by compile() and rebuilt lazily after an append
+        self._index = None
+        self._compiled = False
+        # Optional LRU of match results, see enable_cache()
+        self._cache = None
+        self._cache_size = 0
+        self._cache_variables = None
+        self.cache_hits = 0
+        self.cache_misses = 0
         if conditions:
             for c in conditions:
                 self.append(c)
+        if cache_size:
+            self.enable_cache(cache_size)
 
     def append(self, c):
             if not isinstance(c, TypedConditionSet):
-                c = TypedConditionSet(c)
+                with self.registry:
+                    c = TypedConditionSet(c)
             self.condition_sets.append(c)
+            self._index = None
+            self.clear_cache()
+
+    def enable_cache(self, cache_size=1024):
+        # Memoize match results keyed on the values of the referenced variables only.
+        # Worth it for quantized inputs that repeat, ie, integer bpm and SpO2.
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self.clear_cache()
+
+    def clear_cache(self):
+        # Needed after editing a condition set in place; append clears it already
+        if self._cache is not None:
+            self._cache.clear()
+        self._cache_variables = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _referenced_variables(self):
+        # Referenced variables in id order, or False if any rule depends on history
+        variables = {}
+        for condition_set in self.condition_sets:
+            for condition in condition_set.typed_conditions:
+                if condition.operator in ('TLT', 'TGT'):
+                    return False
+                variables[condition.variable.id] = condition.variable
+        return [variables[i] for i in sorted(variables)]
+
+    def _cached_match_index(self, values):
+        if self._cache_variables is None:
+            self._cache_variables = self._referenced_variables()
+        variables = self._cache_variables
+        if variables is False:
+            return self._match_index(values)
+
+        if isinstance(values, TypedValueSet):
+            key = tuple([values.get(variable) for variable in variables])
+        else:
+            if not all(isinstance(k, basestring) for k in values):
+                values = dict((k if isinstance(k, basestring) else k.name, v) for k, v in values.iteritems())
+            key = tuple([values.get(variable.name) for variable in variables])
+
+        cache = self._cache
+        try:
+            result = cache.pop(key)
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable values are not cached
+            return self._match_index(values)
+        else:
+            cache[key] = result
+            self.cache_hits += 1
+            return result
+
+        self.cache_misses += 1
+        result = self._match_index(values)
+        cache[key] = result
+        while len(cache) > self._cache_size:
+            cache.popitem(last=False)
+        return result
+
+    def compile(self):
+        # Switch matching over to a per-variable threshold index.  Call again after
+        # editing a condition set in place; appends are picked up automatically.
+        self._compiled = True
+        self._index = ConditionSetIndex(self.condition_sets, self.registry)
+        return self._index
+
+    def match_index(self, values):
+        # Position of the first satisfied condition set, or None
+        if self._cache is not None:
+            return self._cached_match_index(values)
+        return self._match_index(values)
+
+    def _match_index(self, values):
+        if self._compiled:
+            if self._index is None:
+                self.compile()
+            return self._index.match(values)
 
-    def match_condition_set(self, values):
         if not isinstance(values, TypedValueSet):
-            values = TypedValueSet(values)
+            values = TypedValueSet(values, self.registry)
 
-        for condition_set in self.condition_sets:
+        for i, condition_set in enumerate(self.condition_sets):
             if condition_set.satisfied_by(values):
                 # logging.debug('Satisfied by {0}'.format(condition_set))
-                return condition_set
+                return i
+
+    def match_condition_set(self, values):
+        i = self.match_index(values)
+        if i is not None:
+            return self.condition_sets[i]
+
+    def analyze(self):
+        return ConditionSetAnalysis(self)
+
+    def prune(self):
+        # Equivalent rule set without dead or shadowed rules
+        return self.analyze().pruned()
+
+    def match_frames(self, frames):
+        # Batch match_index: an int array with the first matching rule for each frame,
+        # or -1 where nothing matched
+        frames = TypedValueFrames(frames)
+        result = np.empty(frames.length, dtype=int)
+        result.fill(-1)
+        pending = np.ones(frames.length, dtype=bool)
+        for i, condition_set in enumerate(self.condition_sets):
+            hit = pending & condition_set.satisfied_by_frames(frames)
+            result[hit] = i
+            pending &= ~hit
+            if not pending.any():
+                break
+        return result
+
+
+class ConditionSetMonitor(object):
+
+    # Stateful matcher for streams where a single variable changes per tick.  Keeps a
+    # truth bit for every condition and a count of unsatisfied conditions for every
+    # rule, so an update only re-checks the conditions on the changed variable.
+    # Callbacks are called as callback(previous, current) with rule indices (or None)
+    # whenever the first matching rule changes.  With record_history, updates are also
+    # pushed to the history of tracked variables before trend conditions are checked.
+
+    def __init__(self, condition_sets, callback=None, record_history=False):
+        if not isinstance(condition_sets, OrderedConditionSets):
+            condition_sets = OrderedConditionSets(condition_sets)
+        self.condition_sets = condition_sets
+        self.record_history = record_history
+        self.callbacks = []
+        if callback:
+            self.callbacks.append(callback)
+        self.values = {}
+        self.current = None
+        self.rebuild()
+
+    def rebuild(self):
+        # Re-derive all state from the current values, ie, after rules were appended
+        self.watchers = {}
+        self.truth = []
+        self.unsatisfied = []
+        self.satisfied = 0
+        for rule, condition_set in enumerate(self.condition_sets.condition_sets):
+            conditions = condition_set.typed_conditions
+            self.truth.append([False] * len(conditions))
+            self.unsatisfied.append(len(conditions))
+            if not conditions:
+                self.satisfied |= 1 << rule
+            for position, condition in enumerate(conditions):
+                self.watchers.setdefault(condition.variable.name, []).append((rule, position, condition))
+        for name, value in self.values.iteritems():
+            self._evaluate(name, value)
+        return self._changed()
+
+    def _set(self, rule, position, state):
+        truth = self.truth[rule]
+        if truth[position] == state:
+            return
+        truth[position] = state
+        if state:
+            self.unsatisfied[rule] -= 1
+            if not self.unsatisfied[rule]:
+                self.satisfied |= 1 << rule
+        else:
+            if not self.unsatisfied[rule]:
+                self.satisfied &= ~(1 << rule)
+            self.unsatisfied[rule] += 1
+
+    def _evaluate(self, name, value):
+        watchers = self.watchers.get(name)
+        if not watchers:
+            return
+        if value is None:
+            for rule, position, condition in watchers:
+                self._set(rule, position, False)
+            return
+        for rule, position, condition in watchers:
+            self._set(rule, position, condition.predicate(value))
+
+    def _changed(self):
+        previous = self.current
+        if self.satisfied:
+            self.current = (self.satisfied & -self.satisfied).bit_length() - 1
+        else:
+            self.current = None
+        if self.current != previous:
+            for callback in self.callbacks:
+                callback(previous, self.current)
+        return self.current
+
+    def _record(self, name, value, timestamp):
+        watchers = self.watchers.get(name)
+        if watchers:
+            watchers[0][2].variable.push(value, timestamp)
+
+    def update(self, variable, value, timestamp=None):
+        # Apply one delta and return the index of the first matching rule
+        if not isinstance(variable, basestring):
+            variable = variable.name
+        self.values[variable] = value
+        if self.record_history:
+            self._record(variable, value, timestamp)
+        self._evaluate(variable, value)
+        return self._changed()
+
+    def update_many(self, values, timestamp=None):
+        for variable, value in values.iteritems():
+            if not isinstance(variable, basestring):
+                variable = variable.name
+            self.values[variable] = value
+            if self.record_history:
+                self._record(variable, value, timestamp)
+            self._evaluate(variable, value)
+        return self._changed()
+
+    def remove(self, variable):
+        # Variable is no longer reported, so every condition on it fails
+        if not isinstance(variable, basestring):
+            variable = variable.name
+        self.values.pop(variable, None)
+        self._evaluate(variable, None)
+        return self._changed()
+
+    def match_condition_set(self):
+        if self.current is not None:
+            return self.condition_sets.condition_sets[self.current]
+
+
+class _VariableIndex(object):
+
+    # Threshold tables for every condition that references a single variable.  Rules
+    # are bits in an int, so match() returns the mask of rules whose conditions on
+    # this variable all hold for a value, using one bisect per operator kind.
+
+    def __init__(self, universe):
+        self.universe = universe
+        self.referenced = 0
+        self.bounds = {'GT': {}, 'GTE': {}, 'LT': {}, 'LTE': {}}
+        self.eq = {}
+        self.neq = {}
+
+    def add(self, rule, operator, value, *args):
+        bit = 1 << rule
+        self.referenced |= bit
+        if operator == 'IN':
+            self.add(rule, 'GT', value)
+            self.add(rule, 'LT', args[0])
+        elif operator in ('GT', 'GTE'):
+            # Several lower bounds on one variable collapse to the tightest one
+            table = self.bounds[operator]
+            table[rule] = max(table.get(rule, value), value)
+        elif operator in ('LT', 'LTE'):
+            table = self.bounds[operator]
+            table[rule] = min(table.get(rule, value), value)
+        elif operator == 'EQ':
+            allowed = set((value,) + tuple(args))
+            if rule in self.eq:
+                allowed &= self.eq[rule]
+            self.eq[rule] = allowed
+        elif operator == 'NEQ':
+            self.neq.setdefault(rule, set()).add(value)
+        else:
+            raise ValueError('Operator %s cannot be indexed' % operator)
+
+    def finalize(self):
+        # Lower bounds keep prefix masks (rules with threshold below the value),
+        # upper bounds keep suffix masks (rules with threshold above the value)
+        self.tables = []
+        for operator in ('GT', 'GTE', 'LT', 'LTE'):
+            table = self.bounds[operator]
+            if not table:
+                continue
+            items = sorted((threshold, rule) for rule, threshold in table.iteritems())
+            thresholds = [threshold for threshold, rule in items]
+            masks = [0] * (len(items) + 1)
+            if operator in ('GT', 'GTE'):
+                for i, (threshold, rule) in enumerate(items):
+                    masks[i + 1] = masks[i] | (1 << rule)
+            else:
+                for i in range(len(items) - 1, -1, -1):
+                    masks[i] = masks[i + 1] | (1 << items[i][1])
+            members = 0
+            for rule in table:
+                members |= 1 << rule
+            search = bisect_left if operator in ('GT', 'LTE') else bisect_right
+            self.tables.append((search, thresholds, masks, self.universe & ~members))
+
+        self.eq_masks = {}
+        self.eq_pass = self.universe
+        for rule, allowed in self.eq.iteritems():
+            self.eq_pass &= ~(1 << rule)
+            for value in allowed:
+                self.eq_masks[value] = self.eq_masks.get(value, 0) | (1 << rule)
+
+        self.neq_masks = {}
+        for rule, forbidden in self.neq.iteritems():
+            for value in forbidden:
+                self.neq_masks[value] = self.neq_masks.get(value, 0) | (1 << rule)
+        self.neq_all = 0
+        for rule in self.neq:
+            self.neq_all |= 1 << rule
+
+        # A missing variable fails every rule that has a condition on it
+        self.absent = self.universe & ~self.referenced
+
+        del self.bounds, self.eq, self.neq
+
+    def match(self, value):
+        # NaN and None are missing values, see ConditionSetIndex.candidates
+        mask = self.universe
+        for search, thresholds, masks, others in self.tables:
+            mask &= masks[search(thresholds, value)] | others
+        try:
+            if self.eq_masks or self.eq_pass != self.universe:
+                mask &= self.eq_masks.get(value, 0) | self.eq_pass
+            if self.neq_all:
+                mask &= ~self.neq_masks.get(value, 0)
+        except TypeError:
+            # Unhashable, so equal to none of the indexed values
+            mask &= self.eq_pass
+        return mask
+
+
+class ConditionSetIndex(object):
+
+    # Compiled form of an ordered list of condition sets.  Conditions are grouped by
+    # variable name into sorted threshold tables, so a match costs about
+    # O(values x log thresholds) big-int ops instead of a scan over every rule.
+    # Operators that cannot be indexed (trends) are checked the slow way, but only
+    # on rules that pass everything else.
+
+    def __init__(self, condition_sets, registry=None):
+        self.condition_sets = list(condition_sets)
+        self.registry = registry
+        self.universe = (1 << len(self.condition_sets)) - 1
+        self.variables = {}
+        self.fallback = 0
+
+        for rule, condition_set in enumerate(self.condition_sets):
+            for condition in condition_set.typed_conditions:
+                if condition.operator not in ConditionSetIndex.indexed_operators or \
+                        not ConditionSetIndex.hashable(condition):
+                    self.fallback |= 1 << rule
+                    continue
+                name = condition.variable.name
+                if name not in self.variables:
+                    self.variables[name] = _VariableIndex(self.universe)
+                self.variables[name].add(rule, condition.operator, condition.value, *condition.value1)
+
+        for variable_index in self.variables.itervalues():
+            variable_index.finalize()
+
+    indexed_operators = ('GT', 'GTE', 'LT', 'LTE', 'EQ', 'NEQ', 'IN')
+
+    @staticmethod
+    def hashable(condition):
+        # EQ and NEQ values are indexed in dicts
+        if condition.operator not in ('EQ', 'NEQ'):
+            return True
+        try:
+            set((condition.value,) + tuple(condition.value1))
+            return True
+        except TypeError:
+            return False
+
+    def candidates(self, values):
+        # Mask of rules whose indexable conditions all hold
+        mask = self.universe
+        for name, variable_index in self.variables.iteritems():
+            value = values.get(name)
+            # Missing from a TypedValueSet too
+            if value is not None and value == value:
+                mask &= variable_index.match(value)
+            else:
+                mask &= variable_index.absent
+            if not mask:
+                break
+        return mask
+
+    def match(self, values):
+        if isinstance(values, TypedValueSet):
+            typed_values = values
+            values = values.as_dict()
+        else:
+            typed_values = None
+            values = dict((k if isinstance(k, basestring) else k.name, v) for k, v in values.iteritems())
+
+        mask = self.candidates(values)
+        while mask:
+            low = mask & -mask
+            rule = low.bit_length() - 1
+            if not low & self.fallback:
+                return rule
+            if typed_values is None:
+                typed_values = TypedValueSet(values, self.registry)
+            if self.condition_sets[rule].satisfied_by(typed_values):
+                return rule
+            mask ^= low
+
+
+class IntervalSet(object):
+
+    # Union of disjoint intervals over the reals, each (lower, lower_closed, upper,
+    # upper_closed), kept sorted with touching pieces merged.  Used to reason about
+    # the values a set of conditions on one variable can accept.
+
+    inf = float('inf')
+
+    def __init__(self, intervals=()):
+        self.intervals = IntervalSet._normalize(intervals)
+
+    @staticmethod
+    def _normalize(intervals):
+        intervals = [i for i in intervals if i[0] < i[2] or (i[0] == i[2] and i[1] and i[3])]
+        intervals.sort(key=lambda i: (i[0], not i[1]))
+        merged = []
+        for interval in intervals:
+            if merged:
+                lower, lower_closed, upper, upper_closed = merged[-1]
+                if interval[0] < upper or (interval[0] == upper and (upper_closed or interval[1])):
+                    if interval[2] > upper or (interval[2] == upper and interval[3]):
+                        upper, upper_closed = interval[2], interval[3]
+                    merged[-1] = (lower, lower_closed, upper, upper_closed)
+                    continue
+            merged.append(interval)
+        return merged
+
+    @classmethod
+    def everything(cls):
+        return cls([(-cls.inf, False, cls.inf, False)])
+
+    @classmethod
+    def from_condition(cls, condition):
+        # None if the condition cannot be expressed as intervals, ie, trends or
+        # comparisons on non-numeric values
+        values = (condition.value,) + tuple(condition.value1)
+        if condition.operator in ('TLT', 'TGT'):
+            return None
+        for value in values:
+            if not isinstance(value, (int, long, float)) or value != value:
+                return None
+
+        inf = cls.inf
+        value = condition.value
+        if condition.operator == 'GT':
+            return cls([(value, False, inf, False)])
+        elif condition.operator == 'GTE':
+            return cls([(value, True, inf, False)])
+        elif condition.operator == 'LT':
+            return cls([(-inf, False, value, False)])
+        elif condition.operator == 'LTE':
+            return cls([(-inf, False, value, True)])
+        elif condition.operator == 'EQ':
+            return cls([(v, True, v, True) for v in values])
+        elif condition.operator == 'NEQ':
+            return cls([(-inf, False, value, False), (value, False, inf, False)])
+        elif condition.operator == 'IN':
+            return cls([(value, False, condition.value1[0], False)])
+
+    def intersection(self, other):
+        intervals = []
+        for a in self.intervals:
+            for b in other.intervals:
+                if a[0] > b[0] or (a[0] == b[0] and not a[1]):
+                    lower, lower_closed = a[0], a[1]
+                else:
+                    lower, lower_closed = b[0], b[1]
+                if a[2] < b[2] or (a[2] == b[2] and not a[3]):
+                    upper, upper_closed = a[2], a[3]
+                else:
+                    upper, upper_closed = b[2], b[3]
+                intervals.append((lower, lower_closed, upper, upper_closed))
+        return IntervalSet(intervals)
+
+    def issubset(self, other):
+        # Each piece has to fit inside a single piece of other, since other is merged
+        for a in self.intervals:
+            for b in other.intervals:
+                if (b[0] < a[0] or (b[0] == a[0] and (b[1] or not a[1]))) and \
+                   (b[2] > a[2] or (b[2] == a[2] and (b[3] or not a[3]))):
+                    break
+            else:
+                return False
+        return True
+
+    def is_empty(self):
+        return not self.intervals
+
+    def __repr__(self):
+        return ' U '.join('%s%g, %g%s' % ('[' if i[1] else '(', i[0], i[2], ']' if i[3] else ')')
+                          for i in self.intervals) or '{}'
+
+
+class ConditionSetAnalysis(object):
+
+    # Static analysis of an ordered rule set.  Each rule's conditions are merged
+    # into one IntervalSet per variable; a rule with an empty variable can never
+    # fire, and a rule whose region lies inside an earlier rule's region is
+    # shadowed, since the earlier rule always matches first.  Rules with trend or
+    # non-numeric conditions are over-approximated, so they can be shadowed but
+    # never shadow anything.
+
+    def __init__(self, condition_sets):
+        if not isinstance(condition_sets, OrderedConditionSets):
+            condition_sets = OrderedConditionSets(condition_sets)
+        self.condition_sets = condition_sets
+
+        # Per rule, variable name -> IntervalSet and whether that is exact
+        self.regions = []
+        self.exact = []
+        for condition_set in condition_sets.condition_sets:
+            region = {}
+            exact = True
+            for condition in condition_set.typed_conditions:
+                name = condition.variable.name
+                accepted = IntervalSet.from_condition(condition)
+                if accepted is None:
+                    exact = False
+                    accepted = IntervalSet.everything()
+                if name in region:
+                    accepted = region[name].intersection(accepted)
+                region[name] = accepted
+            self.regions.append(region)
+            self.exact.append(exact)
+
+        self.unsatisfiable = []
+        for rule, region in enumerate(self.regions):
+            for accepted in region.itervalues():
+                if accepted.is_empty():
+                    self.unsatisfiable.append(rule)
+                    break
+
+        # Later rule -> the earlier rule that shadows it
+        self.shadowed = {}
+        dead = set(self.unsatisfiable)
+        live = []
+        for rule, region in enumerate(self.regions):
+            if rule in dead:
+                continue
+            for earlier in live:
+                if self._covers(self.regions[earlier], region):
+                    self.shadowed[rule] = earlier
+                    break
+            else:
+                if self.exact[rule]:
+                    live.append(rule)
+
+    @staticmethod
+    def _covers(broader, region):
+        # A variable the broader rule conditions on must also be required here,
+        # since a missing variable fails the broader rule but not this one
+        for name, accepted in broader.iteritems():
+            if name not in region or not region[name].issubset(accepted):
+                return False
+        return True
+
+    def unreachable(self):
+        return sorted(set(self.unsatisfiable) | set(self.shadowed))
+
+    def pruned(self):
+        # Same first-match results, reusing the original condition set objects
+        unreachable = set(self.unreachable())
+        pruned = OrderedConditionSets(registry=self.condition_sets.registry)
+        for rule, condition_set in enumerate(self.condition_sets.condition_sets):
+            if rule not in unreachable:
+                pruned.append(condition_set)
+        return pruned
+
+    def __repr__(self):
+        return '<ss:analysis: %d rules, %d unsatisfiable, %d shadowed>' % \
+            (len(self.regions), len(self.unsatisfiable), len(self.shadowed))
 
 
 def test_ordered_conditions():
@@ -253,6 +1282,243 @@ def test_ordered_conditions():
 
     S.match_condition_set(v)
 
+def test_compiled_conditions():
+
+    import random
+    random.seed(1)
+
+    operators = ['GT', 'GTE', 'LT', 'LTE', 'EQ', 'NEQ', 'IN']
+    rules = []
+    for i in range(200):
+        rule = {}
+        for name in random.sample(['x', 'y', 'z'], random.randint(1, 3)):
+            op = random.choice(operators)
+            if op == 'IN':
+                lower = random.randint(0, 15)
+                rule[name] = (op, lower, lower + random.randint(1, 8))
+            elif op == 'EQ':
+                rule[name] = (op, random.randint(0, 20), random.randint(0, 20))
+            else:
+                rule[name] = (op, random.randint(0, 20))
+        rules.append(rule)
+
+    S = OrderedConditionSets(rules)
+    C = OrderedConditionSets(rules)
+    C.compile()
+
+    for i in range(500):
+        values = {}
+        for name in random.sample(['x', 'y', 'z'], random.randint(0, 3)):
+            values[name] = random.randint(-1, 21) if random.random() > 0.1 else float('nan')
+        assert(S.match_index(values) == C.match_index(values))
+
+    C.append({'w': ('EQ', 1)})
+    assert(C.match_index({'w': 1}) == len(rules))
+
+    # NaN is missing either way, and unhashable EQ values are checked the slow way
+    rules = [{'x': ('NEQ', 1)}, {'v': ('EQ', [1], [2])}, {'v': ('NEQ', 3)}]
+    S = OrderedConditionSets(rules)
+    C = OrderedConditionSets(rules)
+    C.compile()
+    for values in [{'x': float('nan')}, {'x': 2}, {'v': [2]}, {'v': [3]}, {'v': None}]:
+        assert(S.match_index(values) == C.match_index(values))
+    assert(C.match_index({'v': [2]}) == 1 and C.match_index({'x': float('nan')}) is None)
+
+
+def test_condition_frames():
+
+    import random
+    random.seed(2)
+
+    S = OrderedConditionSets([{'x': ('GT', 10), 'y': ('LT', 5)},
+                              {'x': ('IN', 2, 8)},
+                              {'y': ('EQ', 7, 9), 'x': ('NEQ', 1)},
+                              {'x': ('LTE', 1)}])
+
+    x = np.array([random.randint(0, 15) for i in range(300)], dtype=float)
+    y = np.array([random.randint(0, 10) for i in range(300)], dtype=float)
+    y[::7] = np.nan
+    matches = S.match_frames({'x': x, 'y': y})
+
+    for i in range(300):
+        values = {'x': x[i]}
+        if not np.isnan(y[i]):
+            values['y'] = y[i]
+        expected = S.match_index(values)
+        assert(matches[i] == (-1 if expected is None else expected))
+        for condition_set in S.condition_sets:
+            frames = {'x': x[i:i+1], 'y': y[i:i+1]}
+            assert(condition_set.satisfied_by_frames(frames)[0] == condition_set.satisfied_by(TypedValueSet(values)))
+            assert(condition_set.satisfiable_by_frames(frames)[0] == condition_set.satisfiable_by(TypedValueSet(values)))
+
+    block = np.zeros(3, dtype=[('x', float), ('y', float)])
+    block['x'] = [12, 5, 0]
+    assert(list(S.match_frames(block)) == [0, 1, 3])
+
+
+def test_condition_monitor():
+
+    import random
+    random.seed(3)
+
+    S = OrderedConditionSets([{'hr': ('GT', 120), 'spo2': ('LT', 90)},
+                              {'hr': ('IN', 40, 50)},
+                              {'spo2': ('LTE', 85)},
+                              {'hr': ('EQ', 0)}])
+    events = []
+    M = ConditionSetMonitor(S, lambda previous, current: events.append((previous, current)))
+
+    values = {}
+    for i in range(500):
+        name = random.choice(['hr', 'spo2'])
+        if random.random() < 0.05:
+            values.pop(name, None)
+            current = M.remove(name)
+        else:
+            values[name] = random.choice([0, 45, 100, 130]) if name == 'hr' else random.choice([80, 88, 97])
+            current = M.update(name, values[name])
+        assert(current == S.match_index(values))
+
+    assert(events)
+    for (previous, current), (later, _) in zip(events, events[1:]):
+        assert(previous != current and current == later)
+
+
+def test_trending_conditions():
+
+    hr = VariableType(name='trend hr', units='bpm')
+    history = hr.track(10)
+
+    falling = TypedCondition(hr, 'TLT', 60, 30)
+    rising = TypedCondition(hr, 'TGT', 100, 30)
+
+    # Falling 1 bpm/s, longer than the window so the ring buffer wraps
+    for i in range(25):
+        history.push(100 - i, timestamp=1000. + i)
+    assert(len(history) == 10)
+    assert(abs(history.predict(0) - 76) < 1e-6)
+    assert(abs(history.predict(30) - 46) < 1e-6)
+
+    current = TypedValue(hr, 76)
+    assert(falling.satisfied_by(current) is True)
+    assert(rising.satisfied_by(current) is False)
+    assert(history.predict(30, 'ewma') < 76)
+
+    times, values = history.window()
+    assert(list(values) == range(85, 75, -1))
+    assert(times[-1] == 1024.)
+
+    M = ConditionSetMonitor([{'trend spo2': ('TGT', 95, 10)}], record_history=True)
+    VariableType(name='trend spo2').track(5)
+    for i in range(5):
+        current = M.update('trend spo2', 90 + i, timestamp=float(i))
+    assert(current == 0)
+
+    # Batch matching falls back to the values the same way
+    with VariableRegistry('trend frames'):
+        S = OrderedConditionSets([{'t': ('TLT', 60, 10)}, {'t': ('TGT', 100, 10)}])
+        frames = {'t': np.array([50., 80., 120., np.nan])}
+        assert(S.match_index({'t': 50}) == 0)
+        assert(list(S.match_frames(frames)) == [0, -1, 1, -1])
+        VariableType(name='t').track(5).push(40, timestamp=0.)
+        assert(list(S.match_frames(frames)) == [0, 0, 0, -1])
+        assert(S.match_index({'t': 120}) == 0)
+
+
+def test_condition_analysis():
+
+    S = OrderedConditionSets([{'x': ('GT', 10)},                      # 0
+                              {'x': ('GT', 20), 'y': ('LT', 5)},      # 1 shadowed by 0
+                              {'x': ('LT', 3), 'y': ('GT', 4)},       # 2
+                              {'x': ('IN', 5, 5)},                    # 3 dead
+                              {'x': ('EQ', 1, 2), 'y': ('EQ', 6)},    # 4 shadowed by 2
+                              {'y': ('GT', 4)},                       # 5
+                              {'x': ('LTE', 10), 'y': ('NEQ', 4)},    # 6
+                              {'y': ('TGT', 100, 10), 'x': ('GT', 11)}])  # 7 shadowed by 0
+    S.condition_sets[3].typed_conditions.append(TypedCondition('x', 'GT', 7))
+
+    A = S.analyze()
+    assert(A.unsatisfiable == [3])
+    assert(A.shadowed == {1: 0, 4: 2, 7: 0})
+
+    P = A.pruned()
+    assert(len(P.condition_sets) == 4)
+
+    import random
+    random.seed(4)
+    for i in range(500):
+        values = {}
+        for name in random.sample(['x', 'y'], random.randint(0, 2)):
+            values[name] = random.randint(-2, 25)
+        assert(S.match_condition_set(values) is P.match_condition_set(values))
+
+    assert(IntervalSet([(0, False, 1, True), (1, False, 2, False)]).intervals == [(0, False, 2, False)])
+    assert(IntervalSet([(0, True, 0, True)]).issubset(IntervalSet([(0, False, 1, False)])) is False)
+
+
+def test_cached_conditions():
+
+    S = OrderedConditionSets([{'x': ('GT', 10), 'y': ('LT', 5)},
+                              {'x': ('EQ', 7)}], cache_size=2)
+
+    assert(S.match_index({'x': 7, 'unused': 1}) == 1)
+    assert(S.match_index({'x': 7, 'unused': 2}) == 1)
+    assert(S.match_index(TypedValueSet({'x': 7})) == 1)
+    assert((S.cache_hits, S.cache_misses) == (2, 1))
+
+    assert(S.match_index({'x': 12, 'y': 0}) == 0)
+    assert(S.match_index({'x': 0}) is None)
+    assert(S.match_index({'x': 0}) is None)
+    assert(len(S._cache) == 2)
+    assert(S.match_index({'x': 7}) == 1)
+    assert(S.cache_misses == 4)
+
+    S.append({'x': ('LT', 1)})
+    assert(S.match_index({'x': 0}) == 2)
+    assert((S.cache_hits, S.cache_misses) == (0, 1))
+
+    T = OrderedConditionSets([{'x': ('TGT', 1, 10)}], cache_size=10)
+    T.match_index({'x': 7})
+    assert(T.cache_misses == 0)
+
+
+def test_variable_registry():
+
+    hr = VariableType(name='registry hr', units='bpm', dtype='int')
+    assert(VariableType(name='registry hr', units='ignored') is hr and hr.units == 'bpm')
+
+    with VariableRegistry('engine') as registry:
+        scoped = VariableType(name='registry hr')
+        S = OrderedConditionSets([{'registry hr': ('GT', 100)}])
+    assert(scoped is not hr and scoped.registry is registry and scoped.id == 0)
+    assert(S.condition_sets[0].typed_conditions[0].variable is scoped)
+    assert(VariableRegistry.current() is VariableRegistry.default)
+
+    assert(S.match_index({'registry hr': 120}) == 0)
+    assert(S.match_index(TypedValueSet({hr: 120})) == 0)
+    assert(len(registry) == 1)
+
+    registry.reset()
+    assert(len(registry) == 0 and VariableType(name='registry hr', registry=registry) is not scoped)
+
+    # Rules from before a reset don't mistake new variables for theirs
+    registry.reset()
+    with registry:
+        assert(S.match_index(TypedValueSet({'registry spo2': 150})) is None)
+        assert(S.match_index(TypedValueSet({'registry spo2': 90, 'registry hr': 120})) == 0)
+
+    created = []
+    def lookup():
+        for i in range(200):
+            created.append(VariableType(name='registry race %d' % (i % 20)))
+    threads = [threading.Thread(target=lookup) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(len(set(id(v) for v in created)) == 20)
+
+
 def test_satset():
 
     logger = logging.getLogger(__name__)
@@ -308,6 +1574,63 @@ def test_satset():
     assert(A.satisfied_by(U) is False)
 
 
+def test_condition_dispatch():
+
+    assert(TypedCondition('x', 'GT', 5).satisfied_by_value(6) is True)
+    assert(TypedCondition('x', 'GTE', 5).satisfied_by_value(5) is True)
+    assert(TypedCondition('x', 'LT', 5).satisfied_by_value(5) is False)
+    assert(TypedCondition('x', 'LTE', 5).satisfied_by_value(5) is True)
+    assert(TypedCondition('x', 'NEQ', 5).satisfied_by_value(5) is False)
+    assert(TypedCondition('x', 'EQ', 5).satisfied_by_value(5) is True)
+    assert(TypedCondition('x', 'EQ', 5, 7, 9).satisfied_by_value(9) is True)
+    assert(TypedCondition('x', 'EQ', [1], [2]).satisfied_by_value([2]) is True)
+    assert(TypedCondition('x', 'EQ', 5, 7).satisfied_by_value([5]) is False)
+    assert(TypedCondition('x', 'IN', 0, 10).satisfied_by_value(10) is False)
+    assert(repr(TypedCondition('x', 'IN', 0, 10)) == '<ss:tc: 0<x<10>')
+
+    for operator, args in (('FOO', (1,)), ('IN', (1,))):
+        try:
+            TypedCondition('x', operator, *args)
+        except ValueError:
+            pass
+        else:
+            assert(False)
+
+
+def test_typed_value_set():
+
+    hr = VariableType(name='compact hr', dtype='int')
+    alarm = VariableType(name='compact alarm', dtype='boolean')
+
+    V = TypedValueSet({hr: 72, 'compact spo2': 97.5, alarm: False})
+    assert(V.get(hr) == 72 and isinstance(V.get(hr), int))
+    assert(V.get('compact spo2') == 97.5)
+    assert(V.get(alarm) is False)
+    assert(V.as_dict() == {'compact hr': 72, 'compact spo2': 97.5, 'compact alarm': False})
+
+    V.remove('compact spo2')
+    assert('compact spo2' not in V and len(V) == 2)
+
+    # Variables registered after the set was built are still accepted
+    V.add('compact late', 1)
+    assert(TypedValueSet(V).get('compact late') == 1)
+
+    T = TypedConditionSet({'compact hr': ('GT', 60), 'compact alarm': ('EQ', False)})
+    assert(T.satisfied_by(V))
+
+    # The old list interface still changes the set
+    V.typed_values.append(TypedValue(VariableType(name='compact rr'), 12))
+    assert(V.get('compact rr') == 12)
+    V.typed_values.remove(TypedValue(VariableType(name='compact rr'), 12))
+    assert('compact rr' not in V)
+
+    # Values come back as added, whatever the variable's declared dtype
+    V.add(hr, 72.9)
+    assert(V.get(hr) == 72.9 and TypedConditionSet({'compact hr': ('GT', 72.5)}).satisfied_by(V))
+    V.add('compact spo2', 97)
+    assert(isinstance(TypedValueSet(V).get('compact spo2'), int))
+
+
 def test_simple_satset():
     pass
 
@@ -0,0 +1,255 @@
+# Benchmarks for the SatisfiableSet rule engine, with synthetic rule bases and
+# vitals-like value streams.  Rules are alarm-like, with thresholds out in the tails
+# of the value range, so most frames match no rule or a late one and matching has
+# to look at the whole rule base, as with real alarms.  The match_index case
+# reports where frames matched, to check that.  Results are written as JSON lines
+# so runs can be compared, ie:
+#
+#   $ python SatisfiableSetBenchmark.py --sizes 10 1000 100000 --output before.jsonl
+#   $ python SatisfiableSetBenchmark.py --sizes 10 1000 100000 --output after.jsonl
+#   $ python SatisfiableSetBenchmark.py --compare before.jsonl after.jsonl
+
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+from SatisfiableSet import VariableRegistry, TypedValueSet, OrderedConditionSets
+
+
+operator_mixes = {
+    'thresholds': ['GT', 'GTE', 'LT', 'LTE'],
+    'equality':   ['EQ', 'NEQ'],
+    'mixed':      ['GT', 'GTE', 'LT', 'LTE', 'EQ', 'NEQ', 'IN'],
+}
+
+# Upper bound on rules x frames for the full scan, which is O(rules) per frame
+scan_budget = 2000000
+
+
+def variable_names(n_variables):
+    return ['v%d' % i for i in range(n_variables)]
+
+
+def tail_value(rng, low, high, tail, upper):
+    # A value within the lowest or highest tail fraction of the range
+    width = max(1, int((high - low) * tail))
+    return rng.randint(high - width, high) if upper else rng.randint(low, low + width)
+
+
+def random_rule_base(n_rules, n_variables=10, conditions=(1, 3), mix='mixed', value_range=(0, 200), tail=0.1,
+                     seed=0):
+    # List of rule dicts, as taken by OrderedConditionSets.  Each condition only
+    # holds out in a tail of the range, ie, GT a high value or IN a band at one end,
+    # and NEQ, which nearly always holds, never makes up a rule by itself.
+    rng = random.Random(seed)
+    operators = operator_mixes[mix]
+    rare = [operator for operator in operators if operator != 'NEQ'] or ['GT', 'LT']
+    names = variable_names(n_variables)
+    low, high = value_range
+    rules = []
+    for i in range(n_rules):
+        rule = {}
+        chosen = rng.sample(names, rng.randint(conditions[0], min(conditions[1], n_variables)))
+        for n, name in enumerate(chosen):
+            operator = rng.choice(operators if n else rare)
+            upper = rng.random() < 0.5
+            if operator in ('GT', 'GTE'):
+                rule[name] = (operator, tail_value(rng, low, high, tail, True))
+            elif operator in ('LT', 'LTE'):
+                rule[name] = (operator, tail_value(rng, low, high, tail, False))
+            elif operator == 'IN':
+                lower = tail_value(rng, low, high, tail, upper)
+                rule[name] = (operator, lower, lower + rng.randint(2, max(2, int((high - low) * tail))))
+            else:
+                rule[name] = (operator, tail_value(rng, low, high, tail, upper), tail_value(rng, low, high, tail, upper))
+        rules.append(rule)
+    return rules
+
+
+def random_value_stream(n_frames, n_variables=10, missing=0.05, step=2, value_range=(0, 200), seed=0):
+    # List of value dicts.  Each variable is an integer random walk from the middle
+    # of the range, the way normal readings wander, so values are quantized and
+    # repeat the way monitor readings do.
+    rng = random.Random(seed)
+    names = variable_names(n_variables)
+    low, high = value_range
+    margin = (high - low) * 3 // 10
+    current = dict((name, rng.randint(low + margin, high - margin)) for name in names)
+    frames = []
+    for i in range(n_frames):
+        frame = {}
+        for name in names:
+            current[name] = min(high, max(low, current[name] + rng.randint(-step, step)))
+            if rng.random() >= missing:
+                frame[name] = current[name]
+        frames.append(frame)
+    return frames
+
+
+def as_columns(frames, n_variables):
+    # Columnar copy of a value stream for the batch API, NaN for missing values
+    columns = {}
+    for name in variable_names(n_variables):
+        columns[name] = np.array([frame.get(name, np.nan) for frame in frames], dtype=float)
+    return columns
+
+
+def index_distribution(matches):
+    # Where frames matched, from match_frames
+    matched = matches[matches >= 0]
+    return {'frames': len(matches),
+            'unmatched': float(np.mean(matches < 0)) if len(matches) else None,
+            'p50_index': float(np.percentile(matched, 50)) if len(matched) else None,
+            'p90_index': float(np.percentile(matched, 90)) if len(matched) else None}
+
+
+def measure(func, inputs):
+    # Per-call latencies in microseconds
+    latencies = np.empty(len(inputs))
+    begin = time.time()
+    for i, item in enumerate(inputs):
+        start = time.time()
+        func(item)
+        latencies[i] = time.time() - start
+    total = time.time() - begin
+    latencies *= 1e6
+    return {'calls': len(inputs),
+            'total_s': total,
+            'per_s': len(inputs) / total if total else None,
+            'p50_us': float(np.percentile(latencies, 50)),
+            'p90_us': float(np.percentile(latencies, 90)),
+            'p99_us': float(np.percentile(latencies, 99)),
+            'max_us': float(latencies.max())}
+
+
+def run(sizes=(10, 100, 1000, 10000, 100000), n_frames=1000, n_variables=10, mix='mixed', seed=0):
+    logger = logging.getLogger('SatisfiableSetBenchmark')
+    results = []
+    stream = random_value_stream(n_frames, n_variables, seed=seed)
+    columns = as_columns(stream, n_variables)
+
+    for n_rules in sizes:
+        with VariableRegistry('benchmark'):
+            rules = random_rule_base(n_rules, n_variables, mix=mix, seed=seed)
+            S = OrderedConditionSets(rules)
+            value_sets = [TypedValueSet(frame) for frame in stream]
+
+            n_scan = max(5, min(n_frames, scan_budget // n_rules))
+            condition_sets = S.condition_sets
+
+            # Every rule against each frame, so these scale with the rule base too
+            cases = [
+                ('satisfied_by', lambda v: [c.satisfied_by(v) for c in condition_sets], value_sets[:n_scan]),
+                ('satisfiable_by', lambda v: [c.satisfiable_by(v) for c in condition_sets], value_sets[:n_scan]),
+                ('match_condition_set', S.match_condition_set, value_sets[:n_scan]),
+            ]
+            for name, func, inputs in cases:
+                results.append(dict(measure(func, inputs), case=name, rules=n_rules))
+
+            compiled = OrderedConditionSets(rules)
+            start = time.time()
+            compiled.compile()
+            compile_time = time.time() - start
+            results.append(dict(measure(compiled.match_condition_set, stream),
+                                case='match_condition_set_compiled', rules=n_rules, compile_s=compile_time))
+
+            cached = OrderedConditionSets(rules, cache_size=4096)
+            cached.compile()
+            result = measure(cached.match_condition_set, stream)
+            results.append(dict(result, case='match_condition_set_cached', rules=n_rules,
+                                hits=cached.cache_hits, misses=cached.cache_misses))
+
+            start = time.time()
+            matches = S.match_frames(columns)
+            total = time.time() - start
+            results.append({'case': 'match_frames', 'rules': n_rules, 'calls': 1, 'frames': n_frames,
+                            'total_s': total, 'per_s': n_frames / total if total else None})
+            results.append(dict(index_distribution(matches), case='match_index', rules=n_rules,
+                                calls=0, per_s=None))
+
+        for result in results[-7:]:
+            logger.info('%(case)s rules=%(rules)d calls=%(calls)d per_s=%(per_s)s' % result)
+        logger.info('rules=%(rules)d unmatched=%(unmatched)s p50_index=%(p50_index)s' % results[-1])
+
+    meta = {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'frames': n_frames,
+            'variables': n_variables,
+            'mix': mix,
+            'seed': seed}
+    for result in results:
+        result.update(meta)
+    return results
+
+
+def write_results(results, path=None):
+    out = open(path, 'w') if path else sys.stdout
+    try:
+        for result in results:
+            out.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if path:
+            out.close()
+
+
+def read_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(baseline, current):
+    # (case, rules, baseline per_s, current per_s, speedup) for cases in both runs
+    before = dict(((r['case'], r['rules']), r) for r in baseline)
+    rows = []
+    for result in current:
+        key = (result['case'], result['rules'])
+        if key in before and before[key].get('per_s') and result.get('per_s'):
+            rows.append(key + (before[key]['per_s'], result['per_s'], result['per_s'] / before[key]['per_s']))
+    return rows
+
+
+def test_benchmark():
+
+    rules = random_rule_base(50, 4, seed=1)
+    assert(len(rules) == 50 and all(1 <= len(rule) <= 3 for rule in rules))
+    stream = random_value_stream(20, 4, seed=1)
+    assert(len(stream) == 20)
+
+    # Alarm-like: most frames match nothing, rather than stopping at the first rule
+    with VariableRegistry('benchmark test'):
+        S = OrderedConditionSets(random_rule_base(1000, 10, seed=2))
+        distribution = index_distribution(S.match_frames(as_columns(random_value_stream(500, 10, seed=2), 10)))
+    assert(distribution['unmatched'] > 0.5)
+
+    results = run(sizes=(5, 50), n_frames=20, n_variables=4)
+    assert(len(results) == 14 and results[-1]['case'] == 'match_index')
+    rows = compare(results, results)
+    assert(rows and all(row[-1] == 1 for row in rows))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the SatisfiableSet rule engine')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--variables', type=int, default=10)
+    parser.add_argument('--mix', choices=sorted(operator_mixes), default='mixed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'))
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if opts.compare:
+        for row in compare(read_results(opts.compare[0]), read_results(opts.compare[1])):
+            print('%-30s %7d %12.1f %12.1f %7.2fx' % row)
+    else:
+        write_results(run(opts.sizes, opts.frames, opts.variables, opts.mix, opts.seed), opts.output)